@@ -1,14 +1,90 @@
 import json
 import os
 import argparse
-import boto3
+import bisect
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import importlib
+import importlib.util
+import ipaddress
 import re
+import shlex
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # -- Windows
+    fcntl = None
+    import msvcrt
    
 
+# =========================== Timing ===========================
+
+PHASES = {}
+
+@contextlib.contextmanager
+def phase(name):
+    # -- add the wall time spent inside the block to PHASES[name] (reported with -profile)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASES[name] = PHASES.get(name,0) + time.perf_counter() - start
+
+def timed(name):
+    # -- the same as phase(), for a whole function
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            with phase(name):
+                return function(*args,**kwargs)
+        return wrapper
+    return decorator
+
+def importBoto3():
+    # -- boto3 takes a while to import, so it is only imported when it is needed, and the time is reported on its own
+    with phase('import_boto3'):
+        import boto3
+    return boto3
+
+def reportProfile(file,cf,total):
+    summary = {
+        "template" : cf,
+        "total" : round(total,4),
+        "phases" : { name : round(seconds,4) for name,seconds in PHASES.items() }
+    }
+    text = json.dumps(summary,indent = 4)
+    if file == '-':
+        # -- the log goes to stdout, so the summary goes to stderr, where it can be read on its own
+        print(text,file = sys.stderr)
+    else:
+        with open(file,'wt') as P:
+            P.write(text + '\n')
+
 # =========================== Resource Templates ===========================
 
+TEMPLATES = {}
+
+def registerTemplate(type,*required):
+    # -- decorator to register a resource template builder, with the parameters it cannot do without
+    def register(builder):
+        TEMPLATES[type] = (builder,required)
+        return builder
+    return register
+
 def resourceTemplate(name,type,**KW):
-    def check(KW,p):
+    log("INFO",f"ResourceTemplate : Adding resource {type} ({name})")
+    if not type in TEMPLATES:
+        log("FATAL",f"Unknown resource type - {type}")
+
+    builder,required = TEMPLATES[type]
+    for p in required:
         if not p in KW:
             log("FATAL",f"PARAM {p} is missing")
         else:
@@ -16,299 +92,241 @@ def resourceTemplate(name,type,**KW):
                 log("FATAL",f"PARAM {p} is blank")
         log("INFO",f" - Parameter {p} = {KW[p]}")
 
-    log("INFO",f"ResourceTemplate : Adding resource {type} ({name})")
-    if type == "vpc":
-        check(KW,'cidr')
-        return  {
-            "Type" : "AWS::EC2::VPC",
-            "Properties" : {
-                "CidrBlock" : KW['cidr'],
-                "EnableDnsHostnames" : True,
-                "EnableDnsSupport" : True,
-                "InstanceTenancy" : "default"
-            }
-        }
-    elif type == "igw":   
-        return {
-            "Type" : "AWS::EC2::InternetGateway",
-            "Properties" : {}
-        }
-    elif type == "igwattachment":
-        check(KW,'InternetGatewayId')
-        check(KW,'vpc')
-        return {
-            "Type" : "AWS::EC2::VPCGatewayAttachment",
-            "Properties" : {
-                "InternetGatewayId" : { "Ref" : KW['InternetGatewayId'] },
-                "VpcId" : { "Ref" : KW['vpc'] }
-            },
-            "DependsOn" : [ KW['InternetGatewayId'], KW['vpc'] ],
-        }
-    elif type == 'routetable':
-        check(KW,'vpc')
-        return {
-            "Type" : "AWS::EC2::RouteTable",
-            "Properties" : {
-                "VpcId" : { "Ref" : KW['vpc'] },
-                "Tags" : [
-                    {
-                    "Key" : "Name",
-                    "Value" : name
-                    }
-                ],
-            },
-            "DependsOn" : [ KW['vpc'] ]
-        }
-    elif type == 'routeigw':
-        check(KW,'InternetGatewayId')
-        check(KW,'RouteTableId')
-        return {
-            "Type" : "AWS::EC2::Route",
-            "Properties" : {
-                "RouteTableId" : { "Ref" : KW['RouteTableId']  },
-                "DestinationCidrBlock" : "0.0.0.0/0",
-                "GatewayId" : { "Ref" : KW['InternetGatewayId'] },
-            },
-            "DependsOn" : [ KW['InternetGatewayId'], KW['RouteTableId'] ]
-        }
-    elif type == 'routenatgw':
-        check(KW,'RouteTableId')
-        check(KW,'NatGatewayId')
-        return {
-            "Type" : "AWS::EC2::Route",
-            "Properties" : {
-                "RouteTableId" : { "Ref" :  KW['RouteTableId']  },
-                "DestinationCidrBlock" : "0.0.0.0/0",
-                "NatGatewayId" : { "Ref" : KW['NatGatewayId'] },
-            },
-            "DependsOn" : [ KW['NatGatewayId'], KW['RouteTableId'] ]
-        }
-    elif type == 'subnet':
-        check(KW,'vpc')
-        check(KW,'cidr')
-        check(KW,'az')
-        check(KW,'MapPublicIpOnLaunch')
-        return {
-            "Type" : "AWS::EC2::Subnet",
-            "Properties" : {
-                "VpcId" : { "Ref" : KW['vpc'] },
-                "CidrBlock" : KW['cidr'],
-                "AvailabilityZone" : { "Fn::Select" : [  KW['az'], { "Fn::GetAZs" : "" } ] },
-                "MapPublicIpOnLaunch" : KW['MapPublicIpOnLaunch'],
-                "Tags" : [
-                    {
-                    "Key" : "Name",
-                    "Value" : name
-                    }
-                ]
-            }
-        }
-    elif type == 'subnetroute':
-        check(KW,'RouteTableId')
-        check(KW,'SubnetId')
-        return {
-            "Type" : "AWS::EC2::SubnetRouteTableAssociation",
-            "Properties" : {
-                "RouteTableId" : { "Ref" : KW['RouteTableId'] },
-                "SubnetId" : { "Ref" : KW['SubnetId'] }
-            },
-            "DependsOn" : [ KW['RouteTableId'], KW['SubnetId']]
-        }
-    elif type == 'securitygroup':
-        check(KW,'vpc')
-        return {
-            "Type": "AWS::EC2::SecurityGroup",
-            "Properties": {
-                "GroupDescription": "Security Group",
-                "SecurityGroupIngress" : [],
-                "SecurityGroupEgress" : [],
-                "VpcId": { "Ref": KW['vpc'] },
-                "Tags" : [
-                    {
-                    "Key" : "Name",
-                    "Value" : name
-                    }
-                ],
-            }
+    return builder(name,KW)
+
+@registerTemplate('vpc','cidr')
+def vpcTemplate(name,KW):
+    return  {
+        "Type" : "AWS::EC2::VPC",
+        "Properties" : {
+            "CidrBlock" : KW['cidr'],
+            "EnableDnsHostnames" : True,
+            "EnableDnsSupport" : True,
+            "InstanceTenancy" : "default"
         }
-    elif type == 's3':
-        return {
-            "Type": "AWS::S3::Bucket",
-            "Properties" : {
-                "AccessControl": "BucketOwnerFullControl",
-                "PublicAccessBlockConfiguration": {
-                    "BlockPublicAcls": True,
-                    "BlockPublicPolicy": True,
-                    "IgnorePublicAcls": True,
-                    "RestrictPublicBuckets": True
+    }
+
+@registerTemplate('igw')
+def igwTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::InternetGateway",
+        "Properties" : {}
+    }
+
+@registerTemplate('igwattachment','InternetGatewayId','vpc')
+def igwattachmentTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::VPCGatewayAttachment",
+        "Properties" : {
+            "InternetGatewayId" : { "Ref" : KW['InternetGatewayId'] },
+            "VpcId" : { "Ref" : KW['vpc'] }
+        },
+        "DependsOn" : [ KW['InternetGatewayId'], KW['vpc'] ],
+    }
+
+@registerTemplate('routetable','vpc')
+def routetableTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::RouteTable",
+        "Properties" : {
+            "VpcId" : { "Ref" : KW['vpc'] },
+            "Tags" : [
+                {
+                "Key" : "Name",
+                "Value" : name
                 }
-            }
-        }
-    elif type == 'static':
-        return {
-            "Type": "AWS::S3::Bucket",
-            "Properties" : {
-                "AccessControl": "PublicRead",
-                "WebsiteConfiguration" : {
-                    "IndexDocument": "index.html",
-                    "ErrorDocument": "error.html"
+            ],
+        },
+        "DependsOn" : [ KW['vpc'] ]
+    }
+
+@registerTemplate('routeigw','InternetGatewayId','RouteTableId')
+def routeigwTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::Route",
+        "Properties" : {
+            "RouteTableId" : { "Ref" : KW['RouteTableId']  },
+            "DestinationCidrBlock" : "0.0.0.0/0",
+            "GatewayId" : { "Ref" : KW['InternetGatewayId'] },
+        },
+        "DependsOn" : [ KW['InternetGatewayId'], KW['RouteTableId'] ]
+    }
+
+@registerTemplate('routenatgw','RouteTableId','NatGatewayId')
+def routenatgwTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::Route",
+        "Properties" : {
+            "RouteTableId" : { "Ref" :  KW['RouteTableId']  },
+            "DestinationCidrBlock" : "0.0.0.0/0",
+            "NatGatewayId" : { "Ref" : KW['NatGatewayId'] },
+        },
+        "DependsOn" : [ KW['NatGatewayId'], KW['RouteTableId'] ]
+    }
+
+@registerTemplate('subnet','vpc','cidr','az','MapPublicIpOnLaunch')
+def subnetTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::Subnet",
+        "Properties" : {
+            "VpcId" : { "Ref" : KW['vpc'] },
+            "CidrBlock" : KW['cidr'],
+            "AvailabilityZone" : { "Fn::Select" : [  KW['az'], { "Fn::GetAZs" : "" } ] },
+            "MapPublicIpOnLaunch" : KW['MapPublicIpOnLaunch'],
+            "Tags" : [
+                {
+                "Key" : "Name",
+                "Value" : name
                 }
-            },
-            "DeletionPolicy": "Delete"
+            ]
         }
-    elif type == 'staticbucketpolicy':
-        check(KW,'Bucket')
-        return {
-            "Type": "AWS::S3::BucketPolicy",
-            "Properties": {
-                "Bucket": { "Ref" : KW['Bucket']},
-                "PolicyDocument": {
-                    "Version": "2012-10-17",
-                    "Statement": {
-                        "Effect": "Allow",
-                        "Principal": "*",
-                        "Action": "s3:GetObject",
-                        "Resource": { "Fn::Join": [ "", [ "arn:" , { "Ref" : "AWS::Partition"} , ":s3:::", { "Ref": KW['Bucket'] }, "/*" ] ] },
-                    }
+    }
+
+@registerTemplate('subnetroute','RouteTableId','SubnetId')
+def subnetrouteTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::SubnetRouteTableAssociation",
+        "Properties" : {
+            "RouteTableId" : { "Ref" : KW['RouteTableId'] },
+            "SubnetId" : { "Ref" : KW['SubnetId'] }
+        },
+        "DependsOn" : [ KW['RouteTableId'], KW['SubnetId']]
+    }
+
+@registerTemplate('securitygroup','vpc')
+def securitygroupTemplate(name,KW):
+    return {
+        "Type": "AWS::EC2::SecurityGroup",
+        "Properties": {
+            "GroupDescription": "Security Group",
+            "SecurityGroupIngress" : [],
+            "SecurityGroupEgress" : [],
+            "VpcId": { "Ref": KW['vpc'] },
+            "Tags" : [
+                {
+                "Key" : "Name",
+                "Value" : name
                 }
-            },
-            "DependsOn" : [ KW['Bucket'] ]
+            ],
         }
-    elif type == 'eip':
-        return  {
-            "Type" : "AWS::EC2::EIP",
-            "Properties" : {
-                "Domain" : "vpc"
+    }
+
+@registerTemplate('s3')
+def s3Template(name,KW):
+    return {
+        "Type": "AWS::S3::Bucket",
+        "Properties" : {
+            "AccessControl": "BucketOwnerFullControl",
+            "PublicAccessBlockConfiguration": {
+                "BlockPublicAcls": True,
+                "BlockPublicPolicy": True,
+                "IgnorePublicAcls": True,
+                "RestrictPublicBuckets": True
             }
         }
-    elif type == 'natgateway':
-        check(KW,'eip')
-        check(KW,'subnet')
-        return {
-            "Type" : "AWS::EC2::NatGateway",
-            "Properties" : {
-                "AllocationId" : { "Fn::GetAtt" : [ KW['eip'], "AllocationId"] },
-                "SubnetId" : { "Ref" : KW['subnet'] },
+    }
+
+@registerTemplate('static')
+def staticTemplate(name,KW):
+    return {
+        "Type": "AWS::S3::Bucket",
+        "Properties" : {
+            "AccessControl": "PublicRead",
+            "WebsiteConfiguration" : {
+                "IndexDocument": "index.html",
+                "ErrorDocument": "error.html"
             }
-        }
-    elif type == 'autoscaling':
-        check(KW,'LaunchTemplateId')
-        check(KW,'VPCZoneIdentifier')
-        check(KW,'TargetGroupARNs')
-        return {
-            "Type" : "AWS::AutoScaling::AutoScalingGroup",
-            "Properties" : {
-                "AutoScalingGroupName" : name,
-                "DesiredCapacity"   : 1,
-                "LaunchTemplate" : {
-                    "LaunchTemplateId" : { "Ref" : KW['LaunchTemplateId'] },
-                    "Version" : { "Fn::GetAtt": [ KW['LaunchTemplateId'], "LatestVersionNumber" ] }
-                },
-                "VPCZoneIdentifier" : KW['VPCZoneIdentifier'],
-                "MaxSize" : 1,
-                "MinSize" : 1,
-                "TargetGroupARNs" : [{ "Ref" : KW['TargetGroupARNs'] }]
-            },
-            "DependsOn" : [ KW['LaunchTemplateId'] ]
-        }
-    elif type == 'targetgroup':
-        check(KW,'vpc')
-        return {
-            "Type" : "AWS::ElasticLoadBalancingV2::TargetGroup",
-            "Properties" : {
-                "Name" : name,
-                "HealthCheckEnabled" : True,
-                "HealthyThresholdCount" : 2,
-                "HealthCheckTimeoutSeconds" : 20,
-                "VpcId" : { "Ref" : KW['vpc'] },
-                "Port" : 80,
-                "Protocol" : "HTTP",
-                "Matcher" : {
-                    "HttpCode" : "200,302"
+        },
+        "DeletionPolicy": "Delete"
+    }
+
+@registerTemplate('staticbucketpolicy','Bucket')
+def staticbucketpolicyTemplate(name,KW):
+    return {
+        "Type": "AWS::S3::BucketPolicy",
+        "Properties": {
+            "Bucket": { "Ref" : KW['Bucket']},
+            "PolicyDocument": {
+                "Version": "2012-10-17",
+                "Statement": {
+                    "Effect": "Allow",
+                    "Principal": "*",
+                    "Action": "s3:GetObject",
+                    "Resource": { "Fn::Join": [ "", [ "arn:" , { "Ref" : "AWS::Partition"} , ":s3:::", { "Ref": KW['Bucket'] }, "/*" ] ] },
                 }
-            },
-            "DependsOn" : [ KW['vpc'] ]
+            }
+        },
+        "DependsOn" : [ KW['Bucket'] ]
+    }
+
+@registerTemplate('eip')
+def eipTemplate(name,KW):
+    return  {
+        "Type" : "AWS::EC2::EIP",
+        "Properties" : {
+            "Domain" : "vpc"
         }
-    elif type == 'launchtemplate':
-        check(KW,'IamInstanceProfile')
-        check(KW,'ImageId')
-        check(KW,'SecurityGroup')
-        return {
-            "Type":"AWS::EC2::LaunchTemplate",
-            "Properties":{
-                "LaunchTemplateName":name,
-                "LaunchTemplateData":{
-                    "IamInstanceProfile":{ "Arn":{"Fn::GetAtt": [ KW['IamInstanceProfile'], "Arn"]} },
-                    "DisableApiTermination":"true",
-                    "ImageId": { "Ref" : KW['ImageId'] },
-                    "InstanceType":"t2.micro",
-                    "BlockDeviceMappings":[{
-                        "Ebs":{
-                            "VolumeSize":"8",
-                            "VolumeType":"gp2",
-                            "DeleteOnTermination": True,
-                            "Encrypted": True
-                        },
-                        "DeviceName": "/dev/xvda",
-                    }],
-                    "UserData"              : { "Fn::Base64" : { "Fn::Join" : ["\n", [
-                        "#!/usr/bin/bash",
-                        "yum update -y"
-                    ]]}},
-                    "SecurityGroupIds" : [ { "Ref" : KW['SecurityGroup'] } ]  
-                }
-            },
-            "DependsOn" : [
-                KW['IamInstanceProfile']
-            ]
+    }
+
+@registerTemplate('natgateway','eip','subnet')
+def natgatewayTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::NatGateway",
+        "Properties" : {
+            "AllocationId" : { "Fn::GetAtt" : [ KW['eip'], "AllocationId"] },
+            "SubnetId" : { "Ref" : KW['subnet'] },
         }
-    elif type == 'instanceprofile':
-        check(KW,'Role')
-        return {
-            "Type": "AWS::IAM::InstanceProfile",
-            "Properties": {
-                "Path": "/",
-                "Roles": [ { "Ref": KW['Role'] } ]
+    }
+
+@registerTemplate('autoscaling','LaunchTemplateId','VPCZoneIdentifier','TargetGroupARNs')
+def autoscalingTemplate(name,KW):
+    return {
+        "Type" : "AWS::AutoScaling::AutoScalingGroup",
+        "Properties" : {
+            "AutoScalingGroupName" : name,
+            "DesiredCapacity"   : 1,
+            "LaunchTemplate" : {
+                "LaunchTemplateId" : { "Ref" : KW['LaunchTemplateId'] },
+                "Version" : { "Fn::GetAtt": [ KW['LaunchTemplateId'], "LatestVersionNumber" ] }
             },
-            "DependsOn" : [ KW['Role'] ]
-        }
-    elif type == 'ec2role':
-        return {
-            "Type": "AWS::IAM::Role",
-            "Properties": {
-                "AssumeRolePolicyDocument": {
-                    "Version": "2012-10-17",
-                    "Statement": [
-                        {
-                            "Effect": "Allow",
-                            "Principal": { "Service": [  "ec2.amazonaws.com" ] },
-                            "Action": [ "sts:AssumeRole" ]
-                        }
-                    ]
-                },
-                "Path": "/",
-                "ManagedPolicyArns" : [
-                    "arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore"
-                ]
+            "VPCZoneIdentifier" : KW['VPCZoneIdentifier'],
+            "MaxSize" : 1,
+            "MinSize" : 1,
+            "TargetGroupARNs" : [{ "Ref" : KW['TargetGroupARNs'] }]
+        },
+        "DependsOn" : [ KW['LaunchTemplateId'] ]
+    }
+
+@registerTemplate('targetgroup','vpc')
+def targetgroupTemplate(name,KW):
+    return {
+        "Type" : "AWS::ElasticLoadBalancingV2::TargetGroup",
+        "Properties" : {
+            "Name" : name,
+            "HealthCheckEnabled" : True,
+            "HealthyThresholdCount" : 2,
+            "HealthCheckTimeoutSeconds" : 20,
+            "VpcId" : { "Ref" : KW['vpc'] },
+            "Port" : 80,
+            "Protocol" : "HTTP",
+            "Matcher" : {
+                "HttpCode" : "200,302"
             }
-        }
-    elif type == 'ec2instance':
-        check(KW,'IamInstanceProfile')
-        check(KW,'ImageId')
-        check(KW,'SecurityGroup')
-        check(KW,'Subnet')
-        return {
-            "Type" : "AWS::EC2::Instance",
-            "Properties" : {
-                "ImageId" : { "Ref" : KW['ImageId'] },
-                "IamInstanceProfile"    : { "Ref" : KW['IamInstanceProfile'] },
-                "InstanceType" : "t2.micro",
-                "NetworkInterfaces": [ {
-                    #"AssociatePublicIpAddress": "true",
-                    "DeviceIndex": "0",
-                    "GroupSet": [{ "Ref" : KW['SecurityGroup'] }],
-                    "SubnetId": { "Ref" : KW['Subnet'] }
-                } ],
+        },
+        "DependsOn" : [ KW['vpc'] ]
+    }
+
+@registerTemplate('launchtemplate','IamInstanceProfile','ImageId','SecurityGroup')
+def launchtemplateTemplate(name,KW):
+    return {
+        "Type":"AWS::EC2::LaunchTemplate",
+        "Properties":{
+            "LaunchTemplateName":name,
+            "LaunchTemplateData":{
+                "IamInstanceProfile":{ "Arn":{"Fn::GetAtt": [ KW['IamInstanceProfile'], "Arn"]} },
+                "DisableApiTermination":"true",
+                "ImageId": { "Ref" : KW['ImageId'] },
+                "InstanceType":"t2.micro",
                 "BlockDeviceMappings":[{
                     "Ebs":{
                         "VolumeSize":"8",
@@ -318,351 +336,752 @@ def resourceTemplate(name,type,**KW):
                     },
                     "DeviceName": "/dev/xvda",
                 }],
-                "Tags" : [
+                "UserData"              : { "Fn::Base64" : { "Fn::Join" : ["\n", [
+                    "#!/usr/bin/bash",
+                    "yum update -y"
+                ]]}},
+                "SecurityGroupIds" : [ { "Ref" : KW['SecurityGroup'] } ]  
+            }
+        },
+        "DependsOn" : [
+            KW['IamInstanceProfile']
+        ]
+    }
+
+@registerTemplate('instanceprofile','Role')
+def instanceprofileTemplate(name,KW):
+    return {
+        "Type": "AWS::IAM::InstanceProfile",
+        "Properties": {
+            "Path": "/",
+            "Roles": [ { "Ref": KW['Role'] } ]
+        },
+        "DependsOn" : [ KW['Role'] ]
+    }
+
+@registerTemplate('ec2role')
+def ec2roleTemplate(name,KW):
+    return {
+        "Type": "AWS::IAM::Role",
+        "Properties": {
+            "AssumeRolePolicyDocument": {
+                "Version": "2012-10-17",
+                "Statement": [
                     {
-                    "Key" : "Name",
-                    "Value" : name
+                        "Effect": "Allow",
+                        "Principal": { "Service": [  "ec2.amazonaws.com" ] },
+                        "Action": [ "sts:AssumeRole" ]
                     }
-                ],
-                "UserData"              : { "Fn::Base64" : { "Fn::Join" : ["\n", [
-                        "#!/usr/bin/bash",
-                        "yum update -y"
-                    ]]}},
+                ]
             },
-            "DependsOn" : [
-                KW['IamInstanceProfile']
+            "Path": "/",
+            "ManagedPolicyArns" : [
+                "arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore"
             ]
         }
-    elif type == 'rds':
-        check(KW,'MasterUsername')
-        check(KW,"MasterUserPassword")
-        check(KW,"sg")
-        check(KW,'DBSubnetGroupName')
-        return {
-            "Type": "AWS::RDS::DBInstance",
-            "Properties" : {
-                "DBName" : name,
-                "AllocatedStorage": 20,
-                "DBInstanceClass" : "db.t3.micro",
-                "AutoMinorVersionUpgrade": True,
-                "Engine" : "mysql",
-                "MasterUsername" : { "Ref" : KW["MasterUsername"] },
-                "MasterUserPassword" : { "Ref" : KW['MasterUserPassword'] },
-                "MultiAZ" : False,
-                "VPCSecurityGroups" : [ { "Ref" : KW['sg'] } ],
-                "DBSubnetGroupName" : { "Ref" : KW['DBSubnetGroupName'] } 
-            }
-        }
-    elif type == 'dbsubnetgroup':
-        check(KW,"DBSubnetGroupDescription")
-        check(KW,'subnet')
-        SubnetIds = []
-        for s in KW['subnet']:
-            SubnetIds.append({ "Ref" : s})
-        return {
-            "Type": "AWS::RDS::DBSubnetGroup",
-            "Properties": {
-                "DBSubnetGroupDescription" : KW['DBSubnetGroupDescription'],
-                "SubnetIds": SubnetIds,
-            }
-        }
-    elif type == 'lambdaexecutionrole':
-        # is there an inline policy?
-        policies = [
-            {
-                "PolicyName" : { "Fn::Sub": f"${{AWS::StackName}}-{name}" },
-                "PolicyDocument": {
-                    "Version": "2012-10-17",
-                    "Statement": [
-                        { "Effect": "Allow", "Action": ["logs:CreateLogGroup", "logs:CreateLogStream" , "logs:PutLogEvents"], "Resource": "arn:aws:logs:*:*:*" }
-                    ]
+    }
+
+@registerTemplate('ec2instance','IamInstanceProfile','ImageId','SecurityGroup','Subnet')
+def ec2instanceTemplate(name,KW):
+    return {
+        "Type" : "AWS::EC2::Instance",
+        "Properties" : {
+            "ImageId" : { "Ref" : KW['ImageId'] },
+            "IamInstanceProfile"    : { "Ref" : KW['IamInstanceProfile'] },
+            "InstanceType" : "t2.micro",
+            "NetworkInterfaces": [ {
+                #"AssociatePublicIpAddress": "true",
+                "DeviceIndex": "0",
+                "GroupSet": [{ "Ref" : KW['SecurityGroup'] }],
+                "SubnetId": { "Ref" : KW['Subnet'] }
+            } ],
+            "BlockDeviceMappings":[{
+                "Ebs":{
+                    "VolumeSize":"8",
+                    "VolumeType":"gp2",
+                    "DeleteOnTermination": True,
+                    "Encrypted": True
+                },
+                "DeviceName": "/dev/xvda",
+            }],
+            "Tags" : [
+                {
+                "Key" : "Name",
+                "Value" : name
                 }
-            }
+            ],
+            "UserData"              : { "Fn::Base64" : { "Fn::Join" : ["\n", [
+                    "#!/usr/bin/bash",
+                    "yum update -y"
+                ]]}},
+        },
+        "DependsOn" : [
+            KW['IamInstanceProfile']
         ]
-        if os.path.exists(f"{name.replace('ExecutionRole','')}.json"):
-            print(f"- Found {name.replace('ExecutionRole','')}.json - Updating inline policy")
-            with open(f"{name.replace('ExecutionRole','')}.json",'rt') as qq:
-                policies.append({
-                    "PolicyName" : { "Fn::Sub": f"${{AWS::StackName}}-{name.replace('ExecutionRole','')}" },
-                    "PolicyDocument" : json.load(qq)
-                })
-
-        return {
-            "Type": "AWS::IAM::Role",
-            "Properties": {
-                "AssumeRolePolicyDocument": {
-                    "Version": "2012-10-17",
-                    "Statement": [{ "Effect": "Allow", "Principal": {"Service": ["lambda.amazonaws.com"]}, "Action": ["sts:AssumeRole"] }]
-                },
-                "Path": "/",
-                "Policies": policies
-            }
+    }
+
+@registerTemplate('rds','MasterUsername','MasterUserPassword','sg','DBSubnetGroupName')
+def rdsTemplate(name,KW):
+    return {
+        "Type": "AWS::RDS::DBInstance",
+        "Properties" : {
+            "DBName" : name,
+            "AllocatedStorage": 20,
+            "DBInstanceClass" : "db.t3.micro",
+            "AutoMinorVersionUpgrade": True,
+            "Engine" : "mysql",
+            "MasterUsername" : { "Ref" : KW["MasterUsername"] },
+            "MasterUserPassword" : { "Ref" : KW['MasterUserPassword'] },
+            "MultiAZ" : False,
+            "VPCSecurityGroups" : [ { "Ref" : KW['sg'] } ],
+            "DBSubnetGroupName" : { "Ref" : KW['DBSubnetGroupName'] } 
         }
-    elif type == 'lambda':
-        check(KW,'Role')
-        return {
-            "Type": "AWS::Lambda::Function",
-            "Properties": {
-                "Handler": "index.lambda_handler",
-                "Role": { "Fn::GetAtt": [ KW['Role'], "Arn" ] },
-                "Description" : name,
-                "Code": {
-                    "ZipFile":  { "Fn::Join": ["\n", [
-                        "import boto3",
-                        "def lambda_handler(event, context):",
-                        "    return { 'statusCode': 200, 'body': 'ok' }"
-                    ]]}
-                },
-                "Runtime": "python3.9",
-                "FunctionName": { "Fn::Sub": f"${{AWS::StackName}}-{name}" },
-                "Timeout": 300,
-                "TracingConfig": { "Mode": "Active" },
-                "Environment": {
-                    "Variables": {}
-                }
-            },
-            "DependsOn" : [ KW['Role'] ]
+    }
+
+@registerTemplate('dbsubnetgroup','DBSubnetGroupDescription','subnet')
+def dbsubnetgroupTemplate(name,KW):
+    SubnetIds = []
+    for s in KW['subnet']:
+        SubnetIds.append({ "Ref" : s})
+    return {
+        "Type": "AWS::RDS::DBSubnetGroup",
+        "Properties": {
+            "DBSubnetGroupDescription" : KW['DBSubnetGroupDescription'],
+            "SubnetIds": SubnetIds,
         }
-    elif type == 'eventbridgeschedule':
-        check(KW,'cron')
-        check(KW,'target')
-        return {
-            "Type": "AWS::Events::Rule",
-            "Properties": {
-                "Description": f"Scheduled event to trigger the Lambda function {KW['target']}",
-                "ScheduleExpression" : KW['cron'],
-                "State": "ENABLED",
-                "Targets": [{ 
-                    "Arn": { "Fn::GetAtt": [ KW['target'], "Arn" ] },
-                    "Id" : { "Fn::Sub": f"${{AWS::StackName}}-{KW['target']}" }
-                } ]
+    }
+
+@registerTemplate('lambdaexecutionrole')
+def lambdaexecutionroleTemplate(name,KW):
+    # is there an inline policy?
+    policies = [
+        {
+            "PolicyName" : { "Fn::Sub": f"${{AWS::StackName}}-{name}" },
+            "PolicyDocument": {
+                "Version": "2012-10-17",
+                "Statement": [
+                    { "Effect": "Allow", "Action": ["logs:CreateLogGroup", "logs:CreateLogStream" , "logs:PutLogEvents"], "Resource": "arn:aws:logs:*:*:*" }
+                ]
             }
         }
-    elif type == 'lambdaeventbridgepermission':
-        check(KW,'target')
-        check(KW,'eventbridge')
-        return {
-            "Type": "AWS::Lambda::Permission",
-            "Properties": {
-                "FunctionName": { "Ref": KW['target'] },
-                "Action": "lambda:InvokeFunction",
-                "Principal": "events.amazonaws.com",
-                "SourceArn": { "Fn::GetAtt": [ KW['eventbridge'], "Arn"] }
+    ]
+    if os.path.exists(f"{name.replace('ExecutionRole','')}.json"):
+        print(f"- Found {name.replace('ExecutionRole','')}.json - Updating inline policy")
+        with open(f"{name.replace('ExecutionRole','')}.json",'rt') as qq:
+            policies.append({
+                "PolicyName" : { "Fn::Sub": f"${{AWS::StackName}}-{name.replace('ExecutionRole','')}" },
+                "PolicyDocument" : json.load(qq)
+            })
+
+    return {
+        "Type": "AWS::IAM::Role",
+        "Properties": {
+            "AssumeRolePolicyDocument": {
+                "Version": "2012-10-17",
+                "Statement": [{ "Effect": "Allow", "Principal": {"Service": ["lambda.amazonaws.com"]}, "Action": ["sts:AssumeRole"] }]
             },
-            "DependsOn" : [
-                KW['target'],
-                KW['eventbridge']
-            ]
+            "Path": "/",
+            "Policies": policies
         }
-    elif type == 'functionurl':
-        check(KW,'target')
-        return {
-            "Type" : "AWS::Lambda::Url",
-            "Properties" : {
-                "AuthType" : "NONE",
-                "TargetFunctionArn" : { "Ref" : KW['target'] }
-            }
-        }
-    elif type == 'lambdafunctionurlpublicpermission':
-        check(KW,'target')
-        return {
-            "Type": "AWS::Lambda::Permission",
-            "Properties": {
-                "FunctionName": { "Ref": KW['target'] },
-                "Action": "lambda:InvokeFunctionUrl",
-                "Principal": "*",
-                "FunctionUrlAuthType" : "NONE"
+    }
+
+@registerTemplate('lambda','Role')
+def lambdaTemplate(name,KW):
+    return {
+        "Type": "AWS::Lambda::Function",
+        "Properties": {
+            "Handler": "index.lambda_handler",
+            "Role": { "Fn::GetAtt": [ KW['Role'], "Arn" ] },
+            "Description" : name,
+            "Code": {
+                "ZipFile":  { "Fn::Join": ["\n", [
+                    "import boto3",
+                    "def lambda_handler(event, context):",
+                    "    return { 'statusCode': 200, 'body': 'ok' }"
+                ]]}
+            },
+            "Runtime": "python3.9",
+            "FunctionName": { "Fn::Sub": f"${{AWS::StackName}}-{name}" },
+            "Timeout": 300,
+            "TracingConfig": { "Mode": "Active" },
+            "Environment": {
+                "Variables": {}
             }
+        },
+        "DependsOn" : [ KW['Role'] ]
+    }
+
+@registerTemplate('eventbridgeschedule','cron','target')
+def eventbridgescheduleTemplate(name,KW):
+    return {
+        "Type": "AWS::Events::Rule",
+        "Properties": {
+            "Description": f"Scheduled event to trigger the Lambda function {KW['target']}",
+            "ScheduleExpression" : KW['cron'],
+            "State": "ENABLED",
+            "Targets": [{ 
+                "Arn": { "Fn::GetAtt": [ KW['target'], "Arn" ] },
+                "Id" : { "Fn::Sub": f"${{AWS::StackName}}-{KW['target']}" }
+            } ]
         }
-    elif type == 'ssmparameter':
-        check(KW,'value')
-        return {
-            "Type": "AWS::SSM::Parameter",
-            "Properties": {
-                "Name": name,
-                "Value": KW['value'],
-                "Type": "String",
-                "Description": name,
-            }
+    }
+
+@registerTemplate('lambdaeventbridgepermission','target','eventbridge')
+def lambdaeventbridgepermissionTemplate(name,KW):
+    return {
+        "Type": "AWS::Lambda::Permission",
+        "Properties": {
+            "FunctionName": { "Ref": KW['target'] },
+            "Action": "lambda:InvokeFunction",
+            "Principal": "events.amazonaws.com",
+            "SourceArn": { "Fn::GetAtt": [ KW['eventbridge'], "Arn"] }
+        },
+        "DependsOn" : [
+            KW['target'],
+            KW['eventbridge']
+        ]
+    }
+
+@registerTemplate('functionurl','target')
+def functionurlTemplate(name,KW):
+    return {
+        "Type" : "AWS::Lambda::Url",
+        "Properties" : {
+            "AuthType" : "NONE",
+            "TargetFunctionArn" : { "Ref" : KW['target'] }
         }
-    elif type == 'elbv2':
-        check(KW,'subnet')
-        check(KW,'SecurityGroups')
-
-        ss = []
-        for s in KW['subnet']:
-            ss.append({"Ref" : s })
-
-        return {
-            "Type" : "AWS::ElasticLoadBalancingV2::LoadBalancer",
-            "Properties" : {
-                "Scheme" : "internet-facing",
-                "SecurityGroups" : [ { "Ref" : KW['SecurityGroups'] } ],
-                
-                "Subnets" : ss,
-                "Type" : "application"
-            },
-            "DependsOn" : [
-                KW['SecurityGroups']
-            ]
+    }
+
+@registerTemplate('lambdafunctionurlpublicpermission','target')
+def lambdafunctionurlpublicpermissionTemplate(name,KW):
+    return {
+        "Type": "AWS::Lambda::Permission",
+        "Properties": {
+            "FunctionName": { "Ref": KW['target'] },
+            "Action": "lambda:InvokeFunctionUrl",
+            "Principal": "*",
+            "FunctionUrlAuthType" : "NONE"
         }
-    elif type == 'elbv2listener':
-        check(KW,'TargetGroupArn')
-        check(KW,'LoadBalancerArn')
-        return {
-            "Type": "AWS::ElasticLoadBalancingV2::Listener",
-            "Properties": {
-                "DefaultActions": [],
-                "DefaultActions" : [{
-                    "Type" : "forward",
-                    "TargetGroupArn" : { "Ref" : KW['TargetGroupArn'] }
-                }],
-                "LoadBalancerArn": { "Ref": KW['LoadBalancerArn'] },
-                "Port" : 80,
-                "Protocol" : "HTTP"
-                #"Port": 443,
-                #"Protocol": "HTTPS",
-                #"SslPolicy" : "ELBSecurityPolicy-TLS-1-2-Ext-2018-06"
-            },
-            "DependsOn" : [
-                KW['TargetGroupArn'],
-                KW['LoadBalancerArn']
-            ]
+    }
+
+@registerTemplate('ssmparameter','value')
+def ssmparameterTemplate(name,KW):
+    return {
+        "Type": "AWS::SSM::Parameter",
+        "Properties": {
+            "Name": name,
+            "Value": KW['value'],
+            "Type": "String",
+            "Description": name,
         }
-    elif type == 'elbv2listenerredirect':
-        check(KW,'LoadBalancerArn')
-        return {
-            "Type": "AWS::ElasticLoadBalancingV2::Listener",
-            "Properties": {
-                "DefaultActions": [
-                    {
-                        "Type": "redirect",
-                        "RedirectConfig": {
-                            "Protocol": "HTTPS",
-                            "Port": 443,
-                            "Host": "#{host}",
-                            "Path": "/#{path}",
-                            "Query": "#{query}",
-                            "StatusCode": "HTTP_301"
-                        }
+    }
+
+@registerTemplate('elbv2','subnet','SecurityGroups')
+def elbv2Template(name,KW):
+    ss = []
+    for s in KW['subnet']:
+        ss.append({"Ref" : s })
+
+    return {
+        "Type" : "AWS::ElasticLoadBalancingV2::LoadBalancer",
+        "Properties" : {
+            "Scheme" : "internet-facing",
+            "SecurityGroups" : [ { "Ref" : KW['SecurityGroups'] } ],
+            
+            "Subnets" : ss,
+            "Type" : "application"
+        },
+        "DependsOn" : [
+            KW['SecurityGroups']
+        ]
+    }
+
+@registerTemplate('elbv2listener','TargetGroupArn','LoadBalancerArn')
+def elbv2listenerTemplate(name,KW):
+    return {
+        "Type": "AWS::ElasticLoadBalancingV2::Listener",
+        "Properties": {
+            "DefaultActions": [],
+            "DefaultActions" : [{
+                "Type" : "forward",
+                "TargetGroupArn" : { "Ref" : KW['TargetGroupArn'] }
+            }],
+            "LoadBalancerArn": { "Ref": KW['LoadBalancerArn'] },
+            "Port" : 80,
+            "Protocol" : "HTTP"
+            #"Port": 443,
+            #"Protocol": "HTTPS",
+            #"SslPolicy" : "ELBSecurityPolicy-TLS-1-2-Ext-2018-06"
+        },
+        "DependsOn" : [
+            KW['TargetGroupArn'],
+            KW['LoadBalancerArn']
+        ]
+    }
+
+@registerTemplate('elbv2listenerredirect','LoadBalancerArn')
+def elbv2listenerredirectTemplate(name,KW):
+    return {
+        "Type": "AWS::ElasticLoadBalancingV2::Listener",
+        "Properties": {
+            "DefaultActions": [
+                {
+                    "Type": "redirect",
+                    "RedirectConfig": {
+                        "Protocol": "HTTPS",
+                        "Port": 443,
+                        "Host": "#{host}",
+                        "Path": "/#{path}",
+                        "Query": "#{query}",
+                        "StatusCode": "HTTP_301"
                     }
-                ],
-                "LoadBalancerArn": { "Ref": KW['LoadBalancerArn'] },
-                "Port" : 80,
-                "Protocol" : "HTTP"
-                #"Port": 443,
-                #"Protocol": "HTTPS",
-                #"SslPolicy" : "ELBSecurityPolicy-TLS-1-2-Ext-2018-06"
-            },
-            "DependsOn" : [
-                KW['LoadBalancerArn']
-            ]
-        }
-    elif type == 'dynamodb':
-        return {
-            "Type" : "AWS::DynamoDB::Table",
-            "Properties" : {
-                "AttributeDefinitions" : [ {'AttributeName': 'id', 'AttributeType': 'S'} ],
-                "KeySchema" : [ {'AttributeName': 'id', 'KeyType': 'HASH'} ],
-                "ProvisionedThroughput" : {
-                    "ReadCapacityUnits" : "5",
-                    "WriteCapacityUnits" : "5"
-                },
-                "TableName" : name,
-                "Tags" : [{
-                    "Key" : "Name",
-                    "Value" : name
-                }],
-            }
-        }
-    elif type == 'policydynamodb':
-        check(KW,'TableName')
-
-        return {
-            "Effect" : "Allow",
-            "Action" : [
-                "dynamodb:DeleteItem",
-                "dynamodb:GetItem",
-                "dynamodb:PutItem",
-                "dynamodb:Scan",
-                "dynamodb:Query",
-                "dynamodb:UpdateItem"
-            ],
-            "Resource": { "Fn::Join": [ "", [ "arn:" , { "Ref" : "AWS::Partition"} , ":dynamodb:" , { "Ref" : "AWS::Region"} , ":" , { "Ref" : "AWS::AccountId"} , ":table/", { "Ref" : KW['TableName'] } ] ] }
-        }
-    elif type == 'policys3bucket':
-        check(KW,'Bucket')
-
-        return {
-            "Effect" : "Allow",
-            "Action" : [
-                "s3:GetObject",
-                "s3:PutObject",
-                "s3:DeleteObject",
-                "s3:ListBuckets"
+                }
             ],
+            "LoadBalancerArn": { "Ref": KW['LoadBalancerArn'] },
+            "Port" : 80,
+            "Protocol" : "HTTP"
+            #"Port": 443,
+            #"Protocol": "HTTPS",
+            #"SslPolicy" : "ELBSecurityPolicy-TLS-1-2-Ext-2018-06"
+        },
+        "DependsOn" : [
+            KW['LoadBalancerArn']
+        ]
+    }
 
-            "Resource": { "Fn::Join": [ "", [ "arn:" , { "Ref" : "AWS::Partition"} , ":s3:::", { "Ref" : KW['Bucket'] }, "/*" ] ] },
-        }
-    elif type == 'policyssmparameter':
-        check(KW,'parameter')
-        return {
-            "Effect" : "Allow",
-            "Action" : [
-                "ssm:GetParameter",
-            ],
-            "Resource" : [
-                { "Fn::Sub": "arn:${AWS::Partition}:ssm:${AWS::Region}:${AWS::AccountId}:parameter/" + KW['parameter'] }
-            ]
-        }
-    elif type == 'outputfnatt':
-        check(KW,'attribute')
-        check(KW,'description')
-        return {
-            "Value" : { "Fn::GetAtt" : [ name, KW['attribute'] ] },
-            "Description": KW['description']
-        }
-    elif type == 'parameterlatestamiid':
-        return {
-            "Type" : "AWS::SSM::Parameter::Value<AWS::EC2::Image::Id>",
-            "Default" : "/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2",
-            "Description" : "Path to the SSM Parameter that contains the latest Amazon Linux 2 image ID"
-        }
-    elif type == 'parameter':
-        check(KW,'Type')
-        check(KW,'description')
-        if not 'NoEcho' in KW:
-            KW['NoEcho'] = False
-
-        return {
-            "Type" : KW['Type'],
-            "Description" : KW['description'],
-            "NoEcho"        : KW['NoEcho']
+@registerTemplate('dynamodb')
+def dynamodbTemplate(name,KW):
+    return {
+        "Type" : "AWS::DynamoDB::Table",
+        "Properties" : {
+            "AttributeDefinitions" : [ {'AttributeName': 'id', 'AttributeType': 'S'} ],
+            "KeySchema" : [ {'AttributeName': 'id', 'KeyType': 'HASH'} ],
+            "ProvisionedThroughput" : {
+                "ReadCapacityUnits" : "5",
+                "WriteCapacityUnits" : "5"
+            },
+            "TableName" : name,
+            "Tags" : [{
+                "Key" : "Name",
+                "Value" : name
+            }],
         }
-    else:
-        log("FATAL",f"Unknown resource type - {type}")
-   
-   
+    }
+
+@registerTemplate('policydynamodb','TableName')
+def policydynamodbTemplate(name,KW):
+    return {
+        "Effect" : "Allow",
+        "Action" : [
+            "dynamodb:DeleteItem",
+            "dynamodb:GetItem",
+            "dynamodb:PutItem",
+            "dynamodb:Scan",
+            "dynamodb:Query",
+            "dynamodb:UpdateItem"
+        ],
+        "Resource": { "Fn::Join": [ "", [ "arn:" , { "Ref" : "AWS::Partition"} , ":dynamodb:" , { "Ref" : "AWS::Region"} , ":" , { "Ref" : "AWS::AccountId"} , ":table/", { "Ref" : KW['TableName'] } ] ] }
+    }
+
+@registerTemplate('policys3bucket','Bucket')
+def policys3bucketTemplate(name,KW):
+    return {
+        "Effect" : "Allow",
+        "Action" : [
+            "s3:GetObject",
+            "s3:PutObject",
+            "s3:DeleteObject",
+            "s3:ListBuckets"
+        ],
+
+        "Resource": { "Fn::Join": [ "", [ "arn:" , { "Ref" : "AWS::Partition"} , ":s3:::", { "Ref" : KW['Bucket'] }, "/*" ] ] },
+    }
+
+@registerTemplate('policyssmparameter','parameter')
+def policyssmparameterTemplate(name,KW):
+    return {
+        "Effect" : "Allow",
+        "Action" : [
+            "ssm:GetParameter",
+        ],
+        "Resource" : [
+            { "Fn::Sub": "arn:${AWS::Partition}:ssm:${AWS::Region}:${AWS::AccountId}:parameter/" + KW['parameter'] }
+        ]
+    }
+
+@registerTemplate('outputfnatt','attribute','description')
+def outputfnattTemplate(name,KW):
+    return {
+        "Value" : { "Fn::GetAtt" : [ name, KW['attribute'] ] },
+        "Description": KW['description']
+    }
+
+@registerTemplate('parameterlatestamiid')
+def parameterlatestamiidTemplate(name,KW):
+    return {
+        "Type" : "AWS::SSM::Parameter::Value<AWS::EC2::Image::Id>",
+        "Default" : "/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2",
+        "Description" : "Path to the SSM Parameter that contains the latest Amazon Linux 2 image ID"
+    }
+
+@registerTemplate('parameter','Type','description')
+def parameterTemplate(name,KW):
+    if not 'NoEcho' in KW:
+        KW['NoEcho'] = False
+
+    return {
+        "Type" : KW['Type'],
+        "Description" : KW['description'],
+        "NoEcho"        : KW['NoEcho']
+    }
+
+# =========================== Template formats ===========================
+
+YAML = None
+
+def cfnYaml():
+    # -- PyYAML is only needed (and only imported) for .yaml / .yml templates.  The loader and dumper understand the
+    # -- CloudFormation short form intrinsics (!Ref, !GetAtt, !Sub ...), and use LibYAML when it is available
+    global YAML
+    if YAML:
+        return YAML
+
+    try:
+        import yaml
+    except ImportError:
+        log("FATAL","YAML templates need PyYAML - pip install pyyaml")
+
+    fast = getattr(yaml,'__with_libyaml__',False)
+    class Loader(yaml.CSafeLoader if fast else yaml.SafeLoader):
+        pass
+    class Dumper(yaml.CSafeDumper if fast else yaml.SafeDumper):
+        pass
+
+    # -- AWSTemplateFormatVersion: 2010-09-09 is a string to CloudFormation, not a date
+    Loader.yaml_implicit_resolvers = {
+        k : [(tag,regexp) for tag,regexp in v if tag != 'tag:yaml.org,2002:timestamp']
+        for k,v in Loader.yaml_implicit_resolvers.items()
+    }
+
+    def intrinsic(loader,suffix,node):
+        key = suffix if suffix in ['Ref','Condition'] else f"Fn::{suffix}"
+        if isinstance(node,yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+            if suffix == 'GetAtt':
+                value = value.split('.',1)
+        elif isinstance(node,yaml.SequenceNode):
+            value = loader.construct_sequence(node,deep = True)
+        else:
+            value = loader.construct_mapping(node,deep = True)
+        return { key : value }
+    Loader.add_multi_constructor('!',intrinsic)
+
+    def representDict(dumper,data):
+        if len(data) == 1:
+            key,value = next(iter(data.items()))
+            # -- a short form can't hold another short form, so only the innermost function uses it
+            inner = isinstance(value,dict) and len(value) == 1 and (next(iter(value)) in ['Ref','Condition'] or next(iter(value)).startswith('Fn::'))
+            if (key in ['Ref','Condition'] or key.startswith('Fn::')) and not inner:
+                tag = '!' + key.replace('Fn::','')
+                if key == 'Fn::GetAtt' and isinstance(value,list) and len(value) == 2 and all(isinstance(v,str) for v in value):
+                    return dumper.represent_scalar(tag,'.'.join(value))
+                if isinstance(value,list):
+                    return dumper.represent_sequence(tag,value)
+                if isinstance(value,dict):
+                    return dumper.represent_mapping(tag,value)
+                return dumper.represent_scalar(tag,str(value))
+        return dumper.represent_mapping('tag:yaml.org,2002:map',data)
+    Dumper.add_representer(dict,representDict)
+    Dumper.add_multi_representer(dict,representDict)
+
+    Loader.libyaml = fast
+    YAML = (yaml,Loader,Dumper)
+    return YAML
+
+def isYaml(cf):
+    return os.path.splitext(cf)[1].lower() in ['.yaml','.yml']
+
+def parseTemplate(text,cf):
+    if isYaml(cf):
+        yaml,Loader,Dumper = cfnYaml()
+        return yaml.load(text,Loader = Loader) or {}
+    return json.loads(text)
+
+def serializeTemplate(cloudFormation,cf,format = 'pretty',indent = None):
+    # -- pretty is for people, compact is the smallest template, and canonical is compact with the keys sorted,
+    # -- so the same template always gives the same bytes
+    if isYaml(cf):
+        yaml,Loader,Dumper = cfnYaml()
+        return yaml.dump(cloudFormation,Dumper = Dumper,sort_keys = format == 'canonical',default_flow_style = format != 'pretty',allow_unicode = True,width = 1000,indent = indent)
+    if format == 'compact':
+        return json.dumps(cloudFormation,separators = (',',':'))
+    if format == 'canonical':
+        return json.dumps(cloudFormation,separators = (',',':'),sort_keys = True)
+    return json.dumps(cloudFormation,indent = 4 if indent == None else indent)
+
+def benchmark(cloudFormation,repeat):
+    # -- how long it takes to load and dump this template as json, and as yaml, so you can pick the faster format
+    yaml,Loader,Dumper = cfnYaml()
+    print(f"{'Format':<20} {'Size (bytes)':>14} {'Load (ms)':>10} {'Dump (ms)':>10}")
+    for format,cf in [('json','template.json'),('yaml (LibYAML)' if Loader.libyaml else 'yaml','template.yaml')]:
+        text = serializeTemplate(cloudFormation,cf)
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            parseTemplate(text,cf)
+        load = (time.perf_counter() - start) * 1000 / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            serializeTemplate(cloudFormation,cf)
+        dump = (time.perf_counter() - start) * 1000 / repeat
+
+        print(f"{format:<20} {len(text.encode('utf-8')):>14} {load:>10.2f} {dump:>10.2f}")
+
+# =========================== Dependency graph ===========================
+
+def templateReferences(value,path):
+    # -- every logical id that value refers to with Ref, Fn::GetAtt or Fn::Sub, as (id,pointer) pairs
+    if isinstance(value,dict):
+        for key,v in value.items():
+            p = pointer(path,key)
+            if key == 'Ref' and isinstance(v,str):
+                yield v,p
+            elif key == 'Fn::GetAtt' and isinstance(v,(list,str)):
+                target = v[0] if isinstance(v,list) else v.split('.')[0]
+                if isinstance(target,str):
+                    yield target,p
+                yield from templateReferences(v,p)
+            elif key == 'Fn::Sub':
+                text,variables = (v + [{}])[:2] if isinstance(v,list) else (v,{})
+                if isinstance(text,str):
+                    for name in re.findall(r'\$\{([^!}][^}]*)\}',text):
+                        name = name.split('.')[0].strip()
+                        if not name in variables:
+                            yield name,p
+                yield from templateReferences(variables,pointer(p,1))
+            else:
+                yield from templateReferences(v,p)
+    elif isinstance(value,list):
+        for i,v in enumerate(value):
+            yield from templateReferences(v,pointer(path,i))
+
+def dependencyGraph(cloudFormation):
+    # -- one pass over the template.  Returns { resource : { 'refs' : resources it refers to, 'dependsOn' : its DependsOn } }
+    # -- and a list of (pointer,id) for every reference to something that does not exist
+    resources = cloudFormation.get('Resources',{})
+    known = lambda t : t in resources or t in cloudFormation.get('Parameters',{}) or t.startswith('AWS::')
+    graph = {}
+    dangling = []
+    for name,resource in resources.items():
+        if not isinstance(resource,dict):
+            continue
+        path = pointer('/Resources',name)
+        refs = set()
+        for target,p in templateReferences({ k : v for k,v in resource.items() if k != 'DependsOn' },path):
+            if target in resources:
+                refs.add(target)
+            elif not known(target):
+                dangling.append((p,target))
+
+        dependsOn = resource.get('DependsOn',[])
+        single = isinstance(dependsOn,str)
+        dependsOn = [dependsOn] if single else dependsOn
+        for i,d in enumerate(dependsOn):
+            if not d in resources:
+                dangling.append((pointer(path,'DependsOn') if single else pointer(pointer(path,'DependsOn'),i),d))
+        graph[name] = { 'refs' : refs, 'dependsOn' : [d for d in dependsOn if d in resources] }
+
+    for name,output in cloudFormation.get('Outputs',{}).items():
+        for target,p in templateReferences(output,pointer('/Outputs',name)):
+            if not known(target):
+                dangling.append((p,target))
+    return graph,dangling
+
+def dependencies(graph,name):
+    return graph[name]['refs'].union(graph[name]['dependsOn'])
+
+def dependencyCycles(graph):
+    # -- Tarjan's strongly connected components.  Every component with more than one resource, or a resource
+    # -- that depends on itself, is a cycle CloudFormation will refuse to create
+    index = {}
+    low = {}
+    stack = []
+    cycles = []
+    def visit(name):
+        index[name] = low[name] = len(index)
+        stack.append(name)
+        for d in dependencies(graph,name):
+            if not d in index:
+                visit(d)
+                low[name] = min(low[name],low[d])
+            elif d in stack:
+                low[name] = min(low[name],index[d])
+        if low[name] == index[name]:
+            component = stack[stack.index(name):]
+            del stack[stack.index(name):]
+            if len(component) > 1 or name in dependencies(graph,name):
+                cycles.append(sorted(component))
+    for name in graph:
+        if not name in index:
+            visit(name)
+    return cycles
+
+def criticalPath(graph):
+    # -- the longest chain of resources that have to be created one after the other (the graph must not have cycles)
+    longest = {}
+    def chain(name):
+        if not name in longest:
+            longest[name] = max((chain(d) for d in dependencies(graph,name)),key = len,default = []) + [name]
+        return longest[name]
+    return max((chain(name) for name in graph),key = len,default = [])
+
+@timed('prune')
+def pruneDependsOn(cloudFormation):
+    # -- transitive reduction of the DependsOn edges.  A DependsOn is removed when the resource already refers to
+    # -- the other one, or depends on it through another of its dependencies.  References are never touched.
+    graph,dangling = dependencyGraph(cloudFormation)
+    if dependencyCycles(graph):
+        log("FATAL","The template has dependency cycles - run -validate to see them")
+
+    reach = {}
+    def reachable(name):
+        if not name in reach:
+            reach[name] = set()
+            for d in dependencies(graph,name):
+                reach[name].add(d)
+                reach[name] |= reachable(d)
+        return reach[name]
+
+    before = len(criticalPath(graph))
+    removed = 0
+    for name in graph:
+        direct = dependencies(graph,name)
+        redundant = [d for d in graph[name]['dependsOn'] if d in graph[name]['refs'] or any(d in reachable(x) for x in direct if x != d)]
+        if not redundant:
+            continue
+        log("INFO",f"{name} - removing DependsOn {', '.join(redundant)}")
+        removed += len(redundant)
+        resource = cloudFormation['Resources'][name]
+        if isinstance(resource['DependsOn'],str):
+            del resource['DependsOn']
+        else:
+            resource['DependsOn'] = [d for d in resource['DependsOn'] if not d in redundant]
+
+    graph,dangling = dependencyGraph(cloudFormation)
+    log("INFO",f"Removed {removed} DependsOn entries - critical path depth {before} -> {len(criticalPath(graph))}")
+
+@timed('validate')
+def validateTemplate(cloudFormation):
+    # -- check the references between resources.  Returns False if CloudFormation would reject the template
+    graph,dangling = dependencyGraph(cloudFormation)
+    for path,target in dangling:
+        log("ERROR",f"{path} refers to {target}, which does not exist")
+
+    cycles = dependencyCycles(graph)
+    for cycle in cycles:
+        log("ERROR",f"Dependency cycle between {', '.join(cycle)}")
+
+    for name in graph:
+        for d in graph[name]['dependsOn']:
+            if d in graph[name]['refs']:
+                log("WARNING",f"{name} - DependsOn {d} is not needed, it is already implied by a Ref, GetAtt or Sub")
+
+    log("INFO",f"{len(graph)} resources, {sum(len(dependencies(graph,n)) for n in graph)} dependencies")
+    if not cycles:
+        path = criticalPath(graph)
+        log("INFO",f"Critical path depth {len(path)} : {' -> '.join(path)}")
+
+    return not dangling and not cycles
+
 # =========================== Other code procedures ===========================
 
+# -- threads working for one target set LOG.prefix, so their lines can be told apart
+LOG = threading.local()
+
 def log(e,t):
+    t = getattr(LOG,'prefix','') + t
+    # -- each message is written in one go (print() writes the newline separately), so lines from threads don't get mixed up
     if e != '':
-        print(f"[{e}] {t}")
+        print(f"[{e}] {t}\n",end = '')
     else:
-        print("---------------------------------------")
-        print(f"{t}")
-        print("---------------------------------------")
+        print(f"---------------------------------------\n{t}\n---------------------------------------\n",end = '')
 
     if e == "FATAL":
         #input()
         exit(1)
 
+class ResourceIndex(dict):
+    # -- the Resources leaf, indexed by Type and by logical id so lookups don't have to scan the whole template.
+    # -- the index is kept up to date when resources are added, replaced or deleted (changing the Type of a
+    # -- resource in place is not seen - assign the resource again instead)
+    def __init__(self,*args,**kwargs):
+        super().__init__()
+        self.types = {}
+        self.names = []
+        self.update(*args,**kwargs)
+
+    def __setitem__(self,name,resource):
+        t = resource.get('Type')
+        if name in self:
+            old = self[name].get('Type')
+            if old == t:
+                super().__setitem__(name,resource)
+                return
+            del self.types[old][name]
+        else:
+            bisect.insort(self.names,name)
+        super().__setitem__(name,resource)
+        self.types.setdefault(t,{})[name] = True
+
+    def __delitem__(self,name):
+        del self.types[self[name].get('Type')][name]
+        del self.names[bisect.bisect_left(self.names,name)]
+        super().__delitem__(name)
+
+    def update(self,*args,**kwargs):
+        for name,resource in dict(*args,**kwargs).items():
+            self[name] = resource
+
+    def setdefault(self,name,resource = None):
+        if not name in self:
+            self[name] = resource
+        return self[name]
+
+    def pop(self,name,*default):
+        if not name in self:
+            return super().pop(name,*default)
+        resource = self[name]
+        del self[name]
+        return resource
+
+    def popitem(self):
+        name = next(reversed(self))
+        return name,self.pop(name)
+
+    def clear(self):
+        super().clear()
+        self.types = {}
+        self.names = []
+
+    def ofType(self,type):
+        return list(self.types.get(type,{}))
+
+    def withPrefix(self,prefix):
+        i = bisect.bisect_left(self.names,prefix)
+        l = []
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            l.append(self.names[i])
+            i += 1
+        return l
+
+def indexResources(cf):
+    if not isinstance(cf['Resources'],ResourceIndex):
+        cf['Resources'] = ResourceIndex(cf['Resources'])
+    return cf['Resources']
+
 def findResources(cf,res):
-    l = []
-    for r in cf['Resources']:
-        if cf['Resources'][r]['Type'] == res:
-            l.append(r)
-    return l
+    return indexResources(cf).ofType(res)
 
 def resourceSelector(cf,cmdline,resourcetype,id = None,param = None):
     # == did we specify something on the command line?
@@ -706,21 +1125,50 @@ def resourceSelector(cf,cmdline,resourcetype,id = None,param = None):
                 log("INFO",f" - {y}")
             log("FATAL","Cannot assume a single resource to use")
 
+def parsePorts(ports):
+    # -- "80", "8000-8100" or "80,443,8000-8100" as a list of (from,to) ranges, with contiguous and overlapping ports joined up
+    ranges = []
+    for p in str(ports).split(','):
+        try:
+            low,_,high = p.strip().partition('-')
+            low,high = int(low),int(high or low)
+        except ValueError:
+            log("FATAL",f"Not a port, port range or list of ports - {ports}")
+        if not 0 <= low <= high <= 65535:
+            log("FATAL",f"Not a valid port range - {p}")
+        ranges.append((low,high))
+    return coalescePorts(ranges)
+
+def coalescePorts(ranges):
+    merged = []
+    for low,high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0],max(merged[-1][1],high))
+        else:
+            merged.append((low,high))
+    return merged
+
 def securityGroupRule(cf,cidr,tcp,udp):
-    
+    # -- returns the list of rules - one for each range of ports
     if tcp and udp:
         log("FATAL","Do not specify both TCP and UDP.  Do them one at a time.")
 
     # == start building a rule
-    rule = { "IpProtocol" : "-1" }
+    rules = [{ "IpProtocol" : "-1" }]
     if tcp != None and udp == None:
-        rule = { "IpProtocol" : "tcp", "FromPort" : tcp, "ToPort" : tcp }
+        rules = [{ "IpProtocol" : "tcp", "FromPort" : str(low), "ToPort" : str(high) } for low,high in parsePorts(tcp)]
     if tcp == None and udp != None:
-        rule = { "IpProtocol" : "udp", "FromPort" : udp, "ToPort" : udp }
+        rules = [{ "IpProtocol" : "udp", "FromPort" : str(low), "ToPort" : str(high) } for low,high in parsePorts(udp)]
+
+    # == is this a CIDR?  It needs its /prefix - ip_network() would also take a bare address (or even a number)
+    try:
+        network = ipaddress.ip_network(cidr,strict = False) if '/' in cidr else None
+    except ValueError:
+        network = None
 
-    # == is this a IPv4 CIDR?
-    if re.match("^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\/\d{1,2}$",cidr):
-        rule['CidrIp'] = cidr
+    if network:
+        for rule in rules:
+            rule['CidrIp' if network.version == 4 else 'CidrIpv6'] = str(network)
     else:
         # -- check if the reference provided is a security group
         if cidr not in cf['Resources']:
@@ -730,17 +1178,112 @@ def securityGroupRule(cf,cidr,tcp,udp):
             if not cf['Resources'][cidr]['Type'] == 'AWS::EC2::SecurityGroup':
                 log("FATAL","You can only link a security group to another security group.")
 
-            rule['SourceSecurityGroupId'] = { "Ref" : cidr }
+            for rule in rules:
+                rule['SourceSecurityGroupId'] = { "Ref" : cidr }
 
-    log('INFO',' - Adding security group rule')
-    return rule
+    return rules
 
-def main():
+def ruleCovers(existing,rule):
+    # -- True if the existing rule already allows everything the new rule does
+    if existing == rule:
+        return True
+    other = lambda r : { k : v for k,v in r.items() if not k in ['FromPort','ToPort','CidrIp','CidrIpv6'] }
+    if other(existing) != other(rule):
+        return False
+    try:
+        if 'FromPort' in rule and not int(existing['FromPort']) <= int(rule['FromPort']) <= int(rule['ToPort']) <= int(existing['ToPort']):
+            return False
+        a = existing.get('CidrIp',existing.get('CidrIpv6'))
+        b = rule.get('CidrIp',rule.get('CidrIpv6'))
+        if a == b:
+            return True
+        a,b = ipaddress.ip_network(a,strict = False),ipaddress.ip_network(b,strict = False)
+        return a.version == b.version and b.subnet_of(a)
+    except (KeyError,TypeError,ValueError):
+        return False
+
+def collapseCidrs(cidrs):
+    # -- merge overlapping and adjacent ranges, and drop duplicates and ranges that are inside bigger ones.  IPv4 first, then IPv6.
+    # -- recipes/cloudflare_s3_bucket_permissions/updateCloudFlareIP.py has a copy (collapse_cidrs) - keep them the same
+    networks = [ipaddress.ip_network(c,strict = False) for c in cidrs]
+    return [str(n) for v in [4,6] for n in ipaddress.collapse_addresses([x for x in networks if x.version == v])]
+
+def mergeRules(rules,fields,value,merge):
+    # -- rules that are the same apart from {fields} are merged - merge() gets the list of value(rule) and returns the
+    # -- fields of each merged rule.  Rules value() returns None for are only de-duplicated.  A group of rules that
+    # -- cannot be merged is left as it was.
+    groups = {}
+    result = []
+    for rule in rules:
+        v = value(rule)
+        if v == None:
+            if not rule in result:
+                result.append(rule)
+            continue
+        key = json.dumps({ k : x for k,x in rule.items() if not k in fields },sort_keys = True)
+        if not key in groups:
+            groups[key] = []
+            result.append(key)
+        groups[key].append((rule,v))
+
+    merged = []
+    for key in result:
+        if isinstance(key,dict):
+            merged.append(key)
+            continue
+        group = groups[key]
+        values = merge([v for r,v in group])
+        if len(values) == len(group):
+            merged += [r for r,v in group]
+            continue
+        for m in values:
+            # -- keep the fields where they were in the first rule
+            rule = {}
+            for k,x in group[0][0].items():
+                if k in fields:
+                    rule.update(m)
+                else:
+                    rule[k] = x
+            rule.update(m)
+            merged.append(rule)
+    return merged
+
+def collapseRules(rules):
+    # -- join up the port ranges of rules that are the same apart from their ports, then merge the CIDRs (with collapseCidrs)
+    # -- of rules that are the same apart from their CIDR.  Duplicate rules are dropped.
+    def ports(rule):
+        try:
+            if str(rule.get('IpProtocol')).lower() in ['tcp','udp','6','17']:
+                return (int(rule['FromPort']),int(rule['ToPort']))
+        except (KeyError,TypeError,ValueError):
+            pass
+        return None
+
+    def cidr(rule):
+        c = rule.get('CidrIp',rule.get('CidrIpv6'))
+        try:
+            ipaddress.ip_network(c,strict = False)
+            return c
+        except (TypeError,ValueError):
+            return None
+
+    rules = mergeRules(rules,['FromPort','ToPort'],ports,lambda values : [{ "FromPort" : str(low), "ToPort" : str(high) } for low,high in coalescePorts(values)])
+    return mergeRules(rules,['CidrIp','CidrIpv6'],cidr,lambda values : [{ ('CidrIpv6' if ':' in c else 'CidrIp') : c } for c in collapseCidrs(values)])
+
+def buildParser():
     parser = argparse.ArgumentParser(description='CloudFormation Helper')
-    parser.add_argument('-cf', help='Path to the CloudFormation json file', required=True)
+    parser.add_argument('-cf', help='Path to the CloudFormation json file (or yaml, if it ends in .yaml or .yml)', required=True)
     parser.add_argument('-add',help='Add a new resource to the CloudFormation file',nargs='+')
     parser.add_argument('-properties',help='Add a custom Properties value into the resource',nargs='+')
-    parser.add_argument('-list',help='List the resources',action='store_true')
+    parser.add_argument('-list',help='List the resources, optionally only those of a type (AWS::EC2::Subnet) or whose name starts with a prefix',nargs='?',const=True)
+    parser.add_argument('-benchmark',help='Time loading and dumping the template as json and as yaml (optionally say how many times, default 5)',nargs='?',const=5,type=int)
+    parser.add_argument('-format',help='How to write the template - pretty (the default), compact (no whitespace) or canonical (compact, with the keys sorted)',choices=['pretty','compact','canonical'],default='pretty')
+    parser.add_argument('-indent',help='How many spaces to indent a pretty template with (default 4 for json, 2 for yaml)',type=int)
+    parser.add_argument('-prune',help='Remove DependsOn entries that are already implied by references or other dependencies',action='store_true')
+    parser.add_argument('-validate',help='Check the references between resources, and report the critical path',action='store_true')
+    parser.add_argument('-dryrun',help='Show what would change in the template, without writing it',action='store_true')
+    parser.add_argument('-export',help='Also write a compact copy of the template to this file (json, or yaml if it ends in .yaml or .yml)')
+    parser.add_argument('-sync',help='Report which Lambda functions and EC2 UserData were updated from their source files',action='store_true')
     parser.add_argument('-nocode',help='Do not update the Lambda function code',action='store_true')
     parser.add_argument('-overwrite',help='Overwrite a resource',action='store_true')
     parser.add_argument('-link',help='Links one resource to another',nargs='+')
@@ -756,27 +1299,77 @@ def main():
     parser.add_argument('-subnet',help='Specify a subnet to use')
     parser.add_argument('-ingress',help='Specify the ingress CIDR range or resource to link to a security group')
     parser.add_argument('-egress',help='Specify the egress CIDR range or resource to link to a security group')
-    parser.add_argument('-tcp',help='Specify the TCP port to link to a security group')
-    parser.add_argument('-udp',help='Specify the TCP port to link to a security group')
+    parser.add_argument('-tcp',help='Specify the TCP port, port range (8000-8100) or list of ports (80,443) to link to a security group')
+    parser.add_argument('-udp',help='Specify the UDP port, port range (8000-8100) or list of ports (80,443) to link to a security group')
     parser.add_argument('-value',help='Specify a value for an SSM Parameter')
 
+    parser.add_argument('-locktimeout',help='How many seconds to wait for another cfh.py working on the same template (default 60)',type=float,default=60)
+    parser.add_argument('-merge',help='Do not hold the lock while working - merge our changes into the template if someone else changed it in the meantime',action='store_true')
+    parser.add_argument('-plugin',help='Load additional resource types from a python module or .py file (can be used more than once, or set CFH_PLUGINS)',action='append')
+    parser.add_argument('-profile',help='Report how long each phase took, as JSON (to stderr, or to this file)',nargs='?',const='-')
+    parser.add_argument('-pstats',help='Save a cProfile of the run to this file (read it with python -m pstats)')
+    parser.add_argument('-script',help='Apply the operations listed in a file (one per line, use - for stdin) and write the template once')
     parser.add_argument('-updatestack',help='Update the CloudFormation stack (specify the stack name)')
-    
-    args = parser.parse_args()
+    parser.add_argument('-targets',help='Update the stack in every profile / region listed in this file (one "profile region [stack]" per line)')
+    parser.add_argument('-workers',help='How many stacks to update at the same time (used by targets, default 10)',type=int,default=10)
+    parser.add_argument('-changeset',help='Update the stack through a change set, and wait for the update to finish (used by updatestack)',action='store_true')
+    parser.add_argument('-deploytimeout',help='How many seconds to wait for a change set and the stack update (used by changeset, default 3600)',type=float,default=3600)
+    parser.add_argument('-stagingbucket',help='S3 bucket (and optional prefix, bucket/prefix) to upload templates and Lambda code that are too big to send to CloudFormation directly',default=os.environ.get('CFH_STAGING_BUCKET'))
+
+    for flags,kwargs in OPTIONS:
+        parser.add_argument(*flags,**kwargs)
+
+    return parser
+
+def readText(file):
+    if not os.path.exists(file):
+        return None
+    with open(file,'rt') as a:
+        return a.read()
 
+@timed('load')
+def loadTemplate(cf):
     # == go get the CF file, and if it doesn't exist, create it
-    if not os.path.exists(args.cf):
-        log("WARNING",f"CloudFormation File {args.cf} does not exist..")
-        cloudFormation = {}
-    else:
-        log("INFO",f"Reading CloudFormation File {args.cf}...")
-        with open(args.cf,'rt') as a:
-            cloudFormation = json.load(a)
+    # -- the text is returned as well, so we can tell later on if anything changed
+    if not os.path.exists(cf):
+        log("WARNING",f"CloudFormation File {cf} does not exist..")
+        return {},None
 
-    # -- set the Description, if the user wanted it to
-    if args.desc:
-        cloudFormation['Description'] = args.desc
+    log("INFO",f"Reading CloudFormation File {cf}...")
+    with open(cf,'rt') as a:
+        original = a.read()
+    return parseTemplate(original,cf),original
+
+@timed('write')
+def writeTemplate(cf,result,original = None):
+    if result == original:
+        log("INFO",f"{cf} is unchanged - not writing it")
+        return False
+
+    log("INFO",f"Writing {cf}")
+    # -- write to a temporary file in the same folder, then rename it over the template, so nobody ever reads half a template
+    target = os.path.realpath(cf)
+    fd,tmp = tempfile.mkstemp(prefix = f".{os.path.basename(target)}.",suffix = '.tmp',dir = os.path.dirname(target))
+    try:
+        with os.fdopen(fd,'wt') as Q:
+            Q.write(result)
+            Q.flush()
+            os.fsync(Q.fileno())
+        if os.path.exists(target):
+            os.chmod(tmp,os.stat(target).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp,0o666 & ~umask)
+        os.replace(tmp,target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
 
+@timed('qa')
+def qaTemplate(cloudFormation):
     # == do a QA on the file -- some things just have to exist in it.  If it doesn't, put it in
     if not 'AWSTemplateFormatVersion' in cloudFormation:
         log("INFO","Setting default AWSTemplateFormatVersion")
@@ -789,279 +1382,1118 @@ def main():
             log("WARNING",f"Creating a blank {x} leaf")
             cloudFormation[x] = {}
 
-    # == list resources
-    if args.list:
-        for r in cloudFormation['Resources']:
-            t = cloudFormation['Resources'][r]['Type']
-            print(f"{t} - {r}")
-        exit(0)
+    indexResources(cloudFormation)
 
-    # == add resources to the file
-    if args.add:
-        if len(args.add) != 2:
-            log("FATAL","When you call -add, you must use the format -add <type> <name>")
-        
-        resource = args.add[0]
-
-        # -- the name must only be alpha numeric
-        name = ''.join(c for c in args.add[1] if c.isalnum())
-        if name != args.add[1]:
-            log("WARNING",f"Resource name {name} has been adjusted to meet CloudFormation requirements.  See \"Logical Id\" in https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/resources-section-structure.html for more information")
-
-        # TODO - we need to figure out how we deal with security groups.. They're a little tricky with the -overwrite option
-        #if name in cloudFormation['Resources'] and not args.overwrite:
-        #    log("FATAL",f"Cannot add resource {name} - it already exists.  Use -overwrite to replace it.")
-
-        log("",f"Adding resources type {resource} - {name}")
-
-        if resource == 'vpc':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'vpc',cidr = args.cidr)
-            cloudFormation['Resources'][f"{name}InternetGateway"] = resourceTemplate(f"{name}InternetGateway",'igw')
-            cloudFormation['Resources'][f"{name}InternetGatewayAttachment"] = resourceTemplate(f"{name}InternetGatewayAttachment","igwattachment",vpc = name, InternetGatewayId = f"{name}InternetGateway")
-            cloudFormation['Resources'][f"{name}RouteTableInternetGateway"] = resourceTemplate(f"{name}RouteTableInternetGateway","routetable",vpc = name)
-            cloudFormation['Resources'][f"{name}RouteInternetGateway"] = resourceTemplate(f"{name}RouteInternetGateway","routeigw",InternetGatewayId = f"{name}InternetGateway",RouteTableId = f"{name}RouteTableInternetGateway")       
-        elif resource == 'publicsubnet':
-            vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC")
-            RouteTable = resourceSelector(cloudFormation,args.routetable,"AWS::EC2::RouteTable")
-            cloudFormation['Resources'][f"{name}"] = resourceTemplate(name,"subnet",vpc = vpc, cidr = args.cidr, az = args.az,MapPublicIpOnLaunch = True )
-            cloudFormation['Resources'][f"{name}Route"] = resourceTemplate(f"{name}Route","subnetroute",RouteTableId = RouteTable, SubnetId = name)     
-        elif resource == 'privatesubnet':
-            vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC")
-            RouteTable = resourceSelector(cloudFormation,args.routetable,"AWS::EC2::RouteTable")
-            cloudFormation['Resources'][f"{name}"] = resourceTemplate(name,"subnet",vpc = vpc, cidr = args.cidr, az = args.az,MapPublicIpOnLaunch = False )
-            cloudFormation['Resources'][f"{name}Route"] = resourceTemplate(f"{name}Route","subnetroute",RouteTableId = RouteTable, SubnetId = name)
-        elif resource == 'securitygroup':
-            vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC","VpcId","AWS::EC2::VPC::Id")
-            if not name in cloudFormation['Resources']:
-                cloudFormation['Resources'][name] = resourceTemplate(name,'securitygroup',vpc = vpc)
-
-            if args.ingress:
-                cloudFormation['Resources'][name]['Properties']['SecurityGroupIngress'].append(
-                    securityGroupRule(cloudFormation,args.ingress,args.tcp,args.udp)
-                )
-            if args.egress:
-                cloudFormation['Resources'][name]['Properties']['SecurityGroupEgress'].append(
-                    securityGroupRule(cloudFormation,args.egress,args.tcp,args.udp)
-                )
-        elif resource == 's3':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'s3')
-        elif resource == 'ec2':
-            subnet = resourceSelector(cloudFormation,args.subnet,"AWS::EC2::Subnet",f"{name}Subnet","AWS::EC2::Subnet::Id")
-            mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
-            
-            cloudFormation['Parameters']['LatestAmiId'] = resourceTemplate(None,'parameterlatestamiid')
-            cloudFormation['Resources'][f"{name}ec2Role"] = resourceTemplate(f"{name}ec2Role","ec2role")
-            cloudFormation['Resources'][f"{name}ec2InstanceProfile"] = resourceTemplate(f"{name}ec2InstanceProfile","instanceprofile",Role = f"{name}ec2Role")
-            cloudFormation['Resources'][name] = resourceTemplate(name,'ec2instance',IamInstanceProfile = f"{name}ec2InstanceProfile", ImageId = 'LatestAmiId',SecurityGroup = mySG,Subnet = subnet)
-        elif resource == 'static':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'static')
-            cloudFormation['Resources'][f"{name}bucketPolicy"] = resourceTemplate(f"{name}bucketPolicy",'staticbucketpolicy',Bucket = name)
-            cloudFormation['Outputs'][name] = resourceTemplate(name,'outputfnatt',attribute = 'WebsiteURL', description = "URL for website hosted on S3" )              
-        elif resource == 'natgateway':
-            subnet = resourceSelector(cloudFormation,args.subnet,"AWS::EC2::Subnet")
-            vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC")
+@timed('list')
+def listResources(cloudFormation,filter = True):
+    # -- filter is either a resource type (AWS::EC2::Subnet) or the start of a logical id (myVPC)
+    if filter == True:
+        names = cloudFormation['Resources']
+    elif '::' in filter:
+        names = findResources(cloudFormation,filter)
+    else:
+        names = indexResources(cloudFormation).withPrefix(filter)
+
+    for r in names:
+        t = cloudFormation['Resources'][r]['Type']
+        print(f"{t} - {r}")
+
+RESOURCES = {}
+
+def registerResource(resource):
+    # -- decorator to register the function that handles -add <resource> <name>
+    def register(adder):
+        RESOURCES[resource] = adder
+        return adder
+    return register
+
+@timed('add')
+def addResource(cloudFormation,args):
+    if len(args.add) != 2:
+        log("FATAL","When you call -add, you must use the format -add <type> <name>")
+    
+    resource = args.add[0]
+
+    # -- the name must only be alpha numeric
+    name = ''.join(c for c in args.add[1] if c.isalnum())
+    if name != args.add[1]:
+        log("WARNING",f"Resource name {name} has been adjusted to meet CloudFormation requirements.  See \"Logical Id\" in https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/resources-section-structure.html for more information")
+
+    # TODO - we need to figure out how we deal with security groups.. They're a little tricky with the -overwrite option
+    #if name in cloudFormation['Resources'] and not args.overwrite:
+    #    log("FATAL",f"Cannot add resource {name} - it already exists.  Use -overwrite to replace it.")
+
+    log("",f"Adding resources type {resource} - {name}")
+
+    if not resource in RESOURCES:
+        log("FATAL",f"Unknown resource type - {resource}")
+
+    RESOURCES[resource](cloudFormation,name,args)
+
+@registerResource('vpc')
+def addVpc(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'vpc',cidr = args.cidr)
+    cloudFormation['Resources'][f"{name}InternetGateway"] = resourceTemplate(f"{name}InternetGateway",'igw')
+    cloudFormation['Resources'][f"{name}InternetGatewayAttachment"] = resourceTemplate(f"{name}InternetGatewayAttachment","igwattachment",vpc = name, InternetGatewayId = f"{name}InternetGateway")
+    cloudFormation['Resources'][f"{name}RouteTableInternetGateway"] = resourceTemplate(f"{name}RouteTableInternetGateway","routetable",vpc = name)
+    cloudFormation['Resources'][f"{name}RouteInternetGateway"] = resourceTemplate(f"{name}RouteInternetGateway","routeigw",InternetGatewayId = f"{name}InternetGateway",RouteTableId = f"{name}RouteTableInternetGateway")
+
+@registerResource('publicsubnet')
+def addPublicsubnet(cloudFormation,name,args):
+    vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC")
+    RouteTable = resourceSelector(cloudFormation,args.routetable,"AWS::EC2::RouteTable")
+    cloudFormation['Resources'][f"{name}"] = resourceTemplate(name,"subnet",vpc = vpc, cidr = args.cidr, az = args.az,MapPublicIpOnLaunch = True )
+    cloudFormation['Resources'][f"{name}Route"] = resourceTemplate(f"{name}Route","subnetroute",RouteTableId = RouteTable, SubnetId = name)
+
+@registerResource('privatesubnet')
+def addPrivatesubnet(cloudFormation,name,args):
+    vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC")
+    RouteTable = resourceSelector(cloudFormation,args.routetable,"AWS::EC2::RouteTable")
+    cloudFormation['Resources'][f"{name}"] = resourceTemplate(name,"subnet",vpc = vpc, cidr = args.cidr, az = args.az,MapPublicIpOnLaunch = False )
+    cloudFormation['Resources'][f"{name}Route"] = resourceTemplate(f"{name}Route","subnetroute",RouteTableId = RouteTable, SubnetId = name)
+
+@registerResource('securitygroup')
+def addSecuritygroup(cloudFormation,name,args):
+    vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC","VpcId","AWS::EC2::VPC::Id")
+    if not name in cloudFormation['Resources']:
+        cloudFormation['Resources'][name] = resourceTemplate(name,'securitygroup',vpc = vpc)
+
+    for direction,cidr in [('SecurityGroupIngress',args.ingress),('SecurityGroupEgress',args.egress)]:
+        if cidr:
+            existing = cloudFormation['Resources'][name]['Properties'][direction]
+            for rule in securityGroupRule(cloudFormation,cidr,args.tcp,args.udp):
+                if any(ruleCovers(e,rule) for e in existing):
+                    ports = 'all traffic' if not 'FromPort' in rule else f"{rule['IpProtocol']} {rule['FromPort']}" if rule['FromPort'] == rule['ToPort'] else f"{rule['IpProtocol']} {rule['FromPort']}-{rule['ToPort']}"
+                    log('WARNING',f" - {direction} already allows {ports} {'from' if direction == 'SecurityGroupIngress' else 'to'} {cidr} - not adding it again")
+                else:
+                    log('INFO',' - Adding security group rule')
+                    existing.append(rule)
+
+    # -- keep the rules as few as possible (a security group can only have 60 of each)
+    for direction in ['SecurityGroupIngress','SecurityGroupEgress']:
+        rules = cloudFormation['Resources'][name]['Properties'][direction]
+        collapsed = collapseRules(rules)
+        if len(collapsed) < len(rules):
+            log("INFO",f" - {direction} : merged {len(rules)} rules into {len(collapsed)}")
+        rules[:] = collapsed
+
+@registerResource('s3')
+def addS3(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'s3')
+
+@registerResource('ec2')
+def addEc2(cloudFormation,name,args):
+    subnet = resourceSelector(cloudFormation,args.subnet,"AWS::EC2::Subnet",f"{name}Subnet","AWS::EC2::Subnet::Id")
+    mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
+
+    cloudFormation['Parameters']['LatestAmiId'] = resourceTemplate(None,'parameterlatestamiid')
+    cloudFormation['Resources'][f"{name}ec2Role"] = resourceTemplate(f"{name}ec2Role","ec2role")
+    cloudFormation['Resources'][f"{name}ec2InstanceProfile"] = resourceTemplate(f"{name}ec2InstanceProfile","instanceprofile",Role = f"{name}ec2Role")
+    cloudFormation['Resources'][name] = resourceTemplate(name,'ec2instance',IamInstanceProfile = f"{name}ec2InstanceProfile", ImageId = 'LatestAmiId',SecurityGroup = mySG,Subnet = subnet)
+
+@registerResource('static')
+def addStatic(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'static')
+    cloudFormation['Resources'][f"{name}bucketPolicy"] = resourceTemplate(f"{name}bucketPolicy",'staticbucketpolicy',Bucket = name)
+    cloudFormation['Outputs'][name] = resourceTemplate(name,'outputfnatt',attribute = 'WebsiteURL', description = "URL for website hosted on S3" )
+
+@registerResource('natgateway')
+def addNatgateway(cloudFormation,name,args):
+    subnet = resourceSelector(cloudFormation,args.subnet,"AWS::EC2::Subnet")
+    vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC")
+
+    cloudFormation['Resources'][f"{name}ElasticIP"] = resourceTemplate(f"{name}ElasticIP",'eip')
+    cloudFormation['Resources'][name] = resourceTemplate(name,"natgateway",subnet = subnet, eip = f"{name}ElasticIP")
+    cloudFormation['Resources'][f"{name}RouteTableNATGateway"] = resourceTemplate(f"{name}RouteTableNATGateway","routetable",vpc = vpc)
+    cloudFormation['Resources'][f"{name}RouteNATGateway"] = resourceTemplate(f"{name}RouteNATGateway","routenatgw", NatGatewayId = name, RouteTableId = f"{name}RouteTableNATGateway")
+
+@registerResource('lambda')
+def addLambda(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'lambda',Role = f"{name}ExecutionRole")
+    cloudFormation['Resources'][f"{name}ExecutionRole"] = resourceTemplate(f"{name}ExecutionRole","lambdaexecutionrole")
+
+@registerResource('launchtemplate')
+def addLaunchtemplate(cloudFormation,name,args):
+    mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
+    cloudFormation['Parameters']['LatestAmiId'] = resourceTemplate(None,'parameterlatestamiid')
+    cloudFormation['Resources'][f"{name}ec2Role"] = resourceTemplate(f"{name}ec2Role","ec2role")
+    cloudFormation['Resources'][f"{name}ec2InstanceProfile"] = resourceTemplate(f"{name}ec2InstanceProfile","instanceprofile",Role = f"{name}ec2Role")
+    cloudFormation['Resources'][f"{name}"] = resourceTemplate(name,'launchtemplate',IamInstanceProfile = f"{name}ec2InstanceProfile", ImageId = "LatestAmiId", SecurityGroup = mySG)
+
+@registerResource('autoscaling')
+def addAutoscaling(cloudFormation,name,args):
+    vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC","VpcId","AWS::EC2::VPC::Id")
+    subnets = resourceSelector(cloudFormation,args.subnet,'AWS::EC2::Subnet',f"{name}Subnets","List<AWS::EC2::Subnet::Id>").split(',')
+    lt = resourceSelector(cloudFormation,args.lt,'AWS::EC2::LaunchTemplate')
+    VPCZoneIdentifier = []
+    for x in subnets:
+        VPCZoneIdentifier.append({"Ref" : x })
+    cloudFormation['Resources'][f"{name}TargetGroup"] = resourceTemplate(name,'targetgroup',vpc = vpc)
+    cloudFormation['Resources'][f"{name}AutoScaling"] = resourceTemplate(f"{name}AutoScaling",'autoscaling',VPCZoneIdentifier = VPCZoneIdentifier, LaunchTemplateId = lt, TargetGroupARNs = f"{name}TargetGroup")
+
+@registerResource('elbv2')
+def addElbv2(cloudFormation,name,args):
+    mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
+    subnets = resourceSelector(cloudFormation,args.subnet,'AWS::EC2::Subnet',f"{name}Subnets","List<AWS::EC2::Subnet::Id>").split(',')
+    target = resourceSelector(cloudFormation,args.target,"AWS::ElasticLoadBalancingV2::TargetGroup")
+
+    cloudFormation['Resources'][name] = resourceTemplate(name,'elbv2',SecurityGroups = mySG, subnet = subnets)
+    cloudFormation['Resources'][f"{name}Listener"] = resourceTemplate(f"{name}Listener",'elbv2listener', LoadBalancerArn = name,TargetGroupArn = target)
+
+    cloudFormation['Outputs'][name] = resourceTemplate(name,'outputfnatt',attribute = 'DNSName', description = "URL for application load balancer" )
+
+@registerResource('parameter')
+def addParameter(cloudFormation,name,args):
+    cloudFormation['Parameters'][name] = resourceTemplate(name,'parameter', description = name, Type = "String")
+
+@registerResource('eventbridge')
+def addEventbridge(cloudFormation,name,args):
+    # -- confirm that target actually exists
+    if cloudFormation['Resources'].get(args.target,{}).get('Type','') == "AWS::Lambda::Function":
+        cloudFormation['Resources'][name] = resourceTemplate(name,'eventbridgeschedule',cron = args.cron, target = args.target)
+        cloudFormation['Resources'][f"{name}lambdaPermission"] = resourceTemplate(f"{name}lambdaPermission","lambdaeventbridgepermission",target = args.target, eventbridge = name)
+    else:
+        log("FATAL","event bridge -target does not exist or is not a Lambda function")
+
+@registerResource('functionurl')
+def addFunctionurl(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'functionurl',target = args.target)
+    cloudFormation['Resources'][f"{name}permission"] = resourceTemplate(f"{name}permission","lambdafunctionurlpublicpermission",target = name)
+    cloudFormation['Outputs'][name] = {
+        "Value" : { "Fn::GetAtt" : [ name, "FunctionUrl" ] },
+        "Description": "URL for Lambda function"
+    }
+
+@registerResource('ssmparameter')
+def addSsmparameter(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'ssmparameter',value = args.value)
+
+@registerResource('rds')
+def addRds(cloudFormation,name,args):
+    cloudFormation['Parameters'][f"{name}MasterUsername"] = resourceTemplate(f"{name}MasterUsername",'parameter', description = f"{name}MasterUsername", Type = "String")
+    cloudFormation['Parameters'][f"{name}MasterUserPassword"] = resourceTemplate(f"{name}MasterUserPassword",'parameter', description = f"{name}MasterUserPassword", Type = "String", NoEcho = True)
+
+    subnets = resourceSelector(cloudFormation,args.subnet,'AWS::EC2::Subnet',f"{name}Subnets","List<AWS::EC2::Subnet::Id>").split(',')
+    mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
+
+    cloudFormation['Resources'][name] = resourceTemplate(name,'rds',MasterUsername = f"{name}MasterUsername",MasterUserPassword = f"{name}MasterUserPassword", sg = mySG, DBSubnetGroupName = f"{name}SubnetGroup")
+    cloudFormation['Resources'][f"{name}SubnetGroup"] = resourceTemplate(f"{name}SubnetGroup",'dbsubnetgroup',DBSubnetGroupDescription = name, subnet = subnets)
+
+    cloudFormation['Outputs'][name] = {
+        "Value" : { "Fn::GetAtt" : [ name, "Endpoint.Address" ] },
+        "Description": "Database Endpoint"
+    }
+
+@registerResource('dynamodb')
+def addDynamodb(cloudFormation,name,args):
+    cloudFormation['Resources'][name] = resourceTemplate(name,'dynamodb')
+
+OPTIONS = []
+
+def registerOption(*flags,**kwargs):
+    # -- lets a plugin add its own command line options, takes the same arguments as argparse's add_argument
+    OPTIONS.append((flags,kwargs))
+
+def loadPlugins(plugins):
+    # -- a plugin is a python module (or a .py file) that calls registerTemplate, registerResource or registerOption when it is imported
+    # -- when cfh.py is run as a script it is __main__, so make sure "import cfh" in a plugin finds these registries and not a fresh copy
+    sys.modules.setdefault('cfh',sys.modules[__name__])
+    if not os.getcwd() in sys.path:
+        sys.path.insert(0,os.getcwd())
+
+    for plugin in plugins:
+        log("INFO",f"Loading plugin {plugin}")
+        if plugin.endswith('.py'):
+            if not os.path.exists(plugin):
+                log("FATAL",f"Plugin file {plugin} does not exist")
+            spec = importlib.util.spec_from_file_location(os.path.basename(plugin)[:-3],plugin)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            try:
+                importlib.import_module(plugin)
+            except ImportError as e:
+                log("FATAL",f"Unable to load plugin {plugin} - {e}")
+
+@timed('properties')
+def updateProperties(cloudFormation,args):
+    name = args.properties[0]
+    KEY = args.properties[1]
+    VALUE = args.properties[2]
+
+    if not name in cloudFormation['Resources']:
+        log("FATAL","Unable to update Properties - resource {name} does not exist.")
+
+    log("WARNING",f"Updating properties for {name}.{KEY} = {VALUE}")
+    cloudFormation['Resources'][name]['Properties'][KEY] = VALUE
+    
+@timed('link')
+def linkResources(cloudFormation,args):
+    if not args.link[0] in cloudFormation['Parameters'] and not args.link[0] in cloudFormation['Resources']:
+        log("FATAL",f"Cannot link {args.link[0]} - it does not exist")
+    if not args.link[1] in cloudFormation['Resources']:
+        log("FATAL",f"Cannot link {args.link[1]} - it does not exist")
+
+    if args.link[0] in cloudFormation['Parameters'] and args.link[1] in cloudFormation['Resources']:
+        if cloudFormation['Resources'][args.link[1]]['Type'] == 'AWS::Lambda::Function':
+            log("INFO",f"Linking Parameter ({args.link[0]}) to Lambda ({args.link[1]})")
+            cloudFormation['Resources'][args.link[1]]['Properties']['Environment']['Variables'][args.link[0]] = { "Ref" : args.link[0] } 
+
+    if args.link[0] in cloudFormation['Resources'] and args.link[1] in cloudFormation['Resources']:
+        # -- linking s3 to ec2
+        if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::S3::Bucket' and cloudFormation['Resources'][args.link[1]]['Type'] == 'AWS::EC2::Instance':
+            log("INFO",f"Linking S3 ({args.link[0]}) to EC2 Role ({args.link[1]})")
+            x = cloudFormation['Resources'][f"{args.link[1]}ec2Role"]['Properties']['AssumeRolePolicyDocument']['Statement']
             
-            cloudFormation['Resources'][f"{name}ElasticIP"] = resourceTemplate(f"{name}ElasticIP",'eip')
-            cloudFormation['Resources'][name] = resourceTemplate(name,"natgateway",subnet = subnet, eip = f"{name}ElasticIP")
-            cloudFormation['Resources'][f"{name}RouteTableNATGateway"] = resourceTemplate(f"{name}RouteTableNATGateway","routetable",vpc = vpc)
-            cloudFormation['Resources'][f"{name}RouteNATGateway"] = resourceTemplate(f"{name}RouteNATGateway","routenatgw", NatGatewayId = name, RouteTableId = f"{name}RouteTableNATGateway")      
-        elif resource == 'lambda':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'lambda',Role = f"{name}ExecutionRole")
-            cloudFormation['Resources'][f"{name}ExecutionRole"] = resourceTemplate(f"{name}ExecutionRole","lambdaexecutionrole")
-        elif resource == 'launchtemplate':
-            mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
-            cloudFormation['Parameters']['LatestAmiId'] = resourceTemplate(None,'parameterlatestamiid')
-            cloudFormation['Resources'][f"{name}ec2Role"] = resourceTemplate(f"{name}ec2Role","ec2role")
-            cloudFormation['Resources'][f"{name}ec2InstanceProfile"] = resourceTemplate(f"{name}ec2InstanceProfile","instanceprofile",Role = f"{name}ec2Role")
-            cloudFormation['Resources'][f"{name}"] = resourceTemplate(name,'launchtemplate',IamInstanceProfile = f"{name}ec2InstanceProfile", ImageId = "LatestAmiId", SecurityGroup = mySG)
-        elif resource == 'autoscaling':
-            vpc = resourceSelector(cloudFormation,args.vpc,"AWS::EC2::VPC","VpcId","AWS::EC2::VPC::Id")
-            subnets = resourceSelector(cloudFormation,args.subnet,'AWS::EC2::Subnet',f"{name}Subnets","List<AWS::EC2::Subnet::Id>").split(',')
-            lt = resourceSelector(cloudFormation,args.lt,'AWS::EC2::LaunchTemplate')
-            VPCZoneIdentifier = []
-            for x in subnets:
-                VPCZoneIdentifier.append({"Ref" : x })
-            cloudFormation['Resources'][f"{name}TargetGroup"] = resourceTemplate(name,'targetgroup',vpc = vpc)
-            cloudFormation['Resources'][f"{name}AutoScaling"] = resourceTemplate(f"{name}AutoScaling",'autoscaling',VPCZoneIdentifier = VPCZoneIdentifier, LaunchTemplateId = lt, TargetGroupARNs = f"{name}TargetGroup")          
-        elif resource == 'elbv2':
-            mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
-            subnets = resourceSelector(cloudFormation,args.subnet,'AWS::EC2::Subnet',f"{name}Subnets","List<AWS::EC2::Subnet::Id>").split(',')
-            target = resourceSelector(cloudFormation,args.target,"AWS::ElasticLoadBalancingV2::TargetGroup")
-
-            cloudFormation['Resources'][name] = resourceTemplate(name,'elbv2',SecurityGroups = mySG, subnet = subnets)
-            cloudFormation['Resources'][f"{name}Listener"] = resourceTemplate(f"{name}Listener",'elbv2listener', LoadBalancerArn = name,TargetGroupArn = target)
+            p = resourceTemplate(None, 'policys3bucket', Bucket = args.link[0])
             
-            cloudFormation['Outputs'][name] = resourceTemplate(name,'outputfnatt',attribute = 'DNSName', description = "URL for application load balancer" )
-        elif resource == 'parameter':
-            cloudFormation['Parameters'][name] = resourceTemplate(name,'parameter', description = name, Type = "String")
-        elif resource == 'eventbridge':
-            # -- confirm that target actually exists
-            if cloudFormation['Resources'].get(args.target,{}).get('Type','') == "AWS::Lambda::Function":
-                cloudFormation['Resources'][name] = resourceTemplate(name,'eventbridgeschedule',cron = args.cron, target = args.target)
-                cloudFormation['Resources'][f"{name}lambdaPermission"] = resourceTemplate(f"{name}lambdaPermission","lambdaeventbridgepermission",target = args.target, eventbridge = name)
+            if not p in x:
+                log("WARNING","Updating policy")
+                x.append(p)
             else:
-                log("FATAL","event bridge -target does not exist or is not a Lambda function")
-        elif resource == 'functionurl':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'functionurl',target = args.target)
-            cloudFormation['Resources'][f"{name}permission"] = resourceTemplate(f"{name}permission","lambdafunctionurlpublicpermission",target = name)
-            cloudFormation['Outputs'][name] = {
-                "Value" : { "Fn::GetAtt" : [ name, "FunctionUrl" ] },
-                "Description": "URL for Lambda function"
-            }
-        elif resource == 'ssmparameter':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'ssmparameter',value = args.value)
-        elif resource == 'rds':
-            cloudFormation['Parameters'][f"{name}MasterUsername"] = resourceTemplate(f"{name}MasterUsername",'parameter', description = f"{name}MasterUsername", Type = "String")
-            cloudFormation['Parameters'][f"{name}MasterUserPassword"] = resourceTemplate(f"{name}MasterUserPassword",'parameter', description = f"{name}MasterUserPassword", Type = "String", NoEcho = True)
+                log("INFO","Policy unchanged")
 
-            subnets = resourceSelector(cloudFormation,args.subnet,'AWS::EC2::Subnet',f"{name}Subnets","List<AWS::EC2::Subnet::Id>").split(',')
-            mySG = resourceSelector(cloudFormation,args.sg,"AWS::EC2::SecurityGroup",f"{name}SecurityGroup","AWS::EC2::SecurityGroup::Id")
+        # -- linking x to lambda
+        if cloudFormation['Resources'][args.link[1]]['Type'] == 'AWS::Lambda::Function':
+            
+            # -- find the Lambda execution policy
+            ExecutionRole = cloudFormation['Resources'][args.link[1]]['Properties']['Role']['Fn::GetAtt'][0]
+            # -- update the Lambda Execution Role policy
+            x = cloudFormation['Resources'][ExecutionRole]['Properties']['Policies'][0]['PolicyDocument']['Statement']
 
-            cloudFormation['Resources'][name] = resourceTemplate(name,'rds',MasterUsername = f"{name}MasterUsername",MasterUserPassword = f"{name}MasterUserPassword", sg = mySG, DBSubnetGroupName = f"{name}SubnetGroup")
-            cloudFormation['Resources'][f"{name}SubnetGroup"] = resourceTemplate(f"{name}SubnetGroup",'dbsubnetgroup',DBSubnetGroupDescription = name, subnet = subnets)
+            if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::DynamoDB::Table':
+                log("INFO",f"Linking DynamoDb ({args.link[0]}) to Lambda ({args.link[1]})")
+                p = resourceTemplate(None, 'policydynamodb', TableName = args.link[0])
 
-            cloudFormation['Outputs'][name] = {
-                "Value" : { "Fn::GetAtt" : [ name, "Endpoint.Address" ] },
-                "Description": "Database Endpoint"
-            }
-        elif resource == 'dynamodb':
-            cloudFormation['Resources'][name] = resourceTemplate(name,'dynamodb')
-        else:
-            log("FATAL",f"Unknown resource type - {resource}")
+            if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::S3::Bucket':
+                log("INFO",f"Linking S3 ({args.link[0]}) to Lambda ({args.link[1]})")
+                p = resourceTemplate(None, 'policys3bucket', Bucket = args.link[0])
+
+            if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::SSM::Parameter':
+                log("INFO",f"Linking SSM Parameter ({args.link[0]}) to Lambda ({args.link[1]})")
+                p = resourceTemplate(None, 'policyssmparameter', parameter = args.link[0])
+
+            if not p in x:
+                log("WARNING","Updating policy")
+                x.append(p)
+            else:
+                log("INFO","Policy unchanged")
             
-    # == Add properties
-    if args.properties:
-        name = args.properties[0]
-        KEY = args.properties[1]
-        VALUE = args.properties[2]
+            # -- update the Lambda variable
+            cloudFormation['Resources'][args.link[1]]['Properties']['Environment']['Variables'][args.link[0]] = { "Ref" : args.link[0] } 
+
+            # -- Add it into the DependsOn (if it's not already there)
+            if args.link[0] not in cloudFormation['Resources'][args.link[1]]['DependsOn']:
+                cloudFormation['Resources'][args.link[1]]['DependsOn'].append(args.link[0])
+
+        #else:
+            #log("FATAL","Unsupported linking direction")
+
+def readSource(file):
+    pc = []
+    with open(file,'rt') as C:
+        for x in C.readlines():
+            pc.append(x.replace('\n',''))
+    return pc
+
+def hashSource(pc):
+    return hashlib.sha256("\n".join(pc).encode('utf-8')).hexdigest()
+
+def joinedLines(block):
+    # -- the list of lines in a { "Fn::Join" : [ "\n", [ ... ] ] } block, or an empty list if it is something else
+    if isinstance(block,dict) and isinstance(block.get('Fn::Join'),list) and len(block['Fn::Join']) == 2 and isinstance(block['Fn::Join'][1],list):
+        return block['Fn::Join'][1]
+    return []
 
-        if not name in cloudFormation['Resources']:
-            log("FATAL","Unable to update Properties - resource {name} does not exist.")
+def readSyncCache(cf):
+    # -- the size, mtime and hash of every file we synced, kept next to the template in {cf}.sync.  It only says
+    # -- what is on this machine, so it is not part of the template (and is not committed with it)
+    text = readText(f"{cf}.sync")
+    try:
+        return json.loads(text) if text else {}
+    except ValueError:
+        log("WARNING",f"{cf}.sync is not valid JSON - ignoring it")
+        return {}
+
+def writeSyncCache(cf,cache):
+    # -- only created once there is a file to remember
+    text = json.dumps(cache,indent = 4,sort_keys = True)
+    if text != readText(f"{cf}.sync") and (cache or os.path.exists(f"{cf}.sync")):
+        writeTemplate(f"{cf}.sync",text)
+
+def userDataLines(properties):
+    # -- the lines of UserData we synced in before, or an empty list if it is something else (like a base64 string)
+    userData = properties.get('UserData')
+    return joinedLines(userData.get('Fn::Base64')) if isinstance(userData,dict) else []
+
+def syncSource(cloudFormation,name,file,current,cache):
+    # -- returns the new lines if {file} has changed since the last sync, or None if the template is up to date.
+    # -- the size and mtime of every file we synced is kept in the cache, so an unchanged file costs a stat() and is never read
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return None
+
+    signature = { "file" : file, "size" : st.st_size, "mtime" : st.st_mtime_ns }
+    entry = cache.get(name,{})
+    if all(entry.get(k) == v for k,v in signature.items()) and entry.get('sha256') == hashSource(current):
+        return None
+
+    pc = readSource(file)
+    sha256 = hashSource(pc)
+    signature['sha256'] = sha256
+    cache[name] = signature
+
+    if sha256 == hashSource(current):
+        return None
+    return pc
+
+LAMBDA_ZIPFILE_LIMIT = 4096
+
+# -- left out of Lambda packages.  PACKAGE_EXCLUDE, packageExcluded, packageFiles and packageLambda are copies of EXCLUDE,
+# -- excluded, packageFiles and buildPackage in lambdaUpdate.py (which cfh.py can't import, as it imports boto3 straight
+# -- away) - keep them the same, so both give the same zip for the same directory
+PACKAGE_EXCLUDE = ['__pycache__', '*.pyc', '.git', 'tests']
+
+def packageExcluded(name):
+    # -- a path is excluded if it, or any of its folders, matches one of the globs
+    parts = name.split('/')
+    return any(fnmatch.fnmatch(name,e) or any(fnmatch.fnmatch(p,e) for p in parts) for e in PACKAGE_EXCLUDE)
+
+def packageFiles(source):
+    # -- the files to package, as (path,name in the zip).  A directory is packaged as it is, a single file becomes index.py
+    if not os.path.isdir(source):
+        return [(source,'index.py')]
+    files = []
+    for root,dirs,names in os.walk(source):
+        dirs[:] = [d for d in dirs if not packageExcluded(os.path.relpath(os.path.join(root,d),source).replace(os.sep,'/'))]
+        for n in names:
+            name = os.path.relpath(os.path.join(root,n),source).replace(os.sep,'/')
+            if not packageExcluded(name):
+                files.append((os.path.join(root,n),name))
+    return sorted(files,key = lambda f : f[1])
+
+def packageLambda(source):
+    # -- zip the Lambda code.  The files are added in sorted order, with a fixed timestamp and permissions, so the
+    # -- same code always gives the same zip (and the same hash), no matter when or where it was packaged
+    import io
+    import zipfile
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer,'w',zipfile.ZIP_DEFLATED) as Z:
+        for file,name in packageFiles(source):
+            info = zipfile.ZipInfo(name,date_time = (1980,1,1,0,0,0))
+            info.external_attr = (0o755 if os.access(file,os.X_OK) else 0o644) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(file,'rb') as F:
+                Z.writestr(info,F.read())
+    return buffer.getvalue()
+
+def syncPackage(cloudFormation,name,source,code,staging,s3,cache,upload = True):
+    # -- package {source}, stage it in S3 and point the Lambda Code at it.  Returns True if the Code changed.
+    # -- like syncSource, the size and mtime of the files are kept in the cache, so unchanged code is never zipped again
+    stats = [[n,st.st_size,st.st_mtime_ns] for f,n in packageFiles(source) for st in [os.stat(f)]]
+    tree = hashlib.sha256(json.dumps(stats).encode('utf-8')).hexdigest()
+    entry = cache.get(name,{})
+    if entry.get('file') == source and entry.get('tree') == tree and code == dict(zip(['S3Bucket','S3Key'],stagedObject(staging,entry.get('sha256'),'zip'))):
+        return False
+
+    body = packageLambda(source)
+    sha256 = hashlib.sha256(body).hexdigest()
+    cache[name] = { "file" : source, "tree" : tree, "sha256" : sha256 }
+
+    bucket,key = stagedObject(staging,sha256,'zip')
+    if code == { "S3Bucket" : bucket, "S3Key" : key }:
+        return False
+    if upload:
+        stageObject(s3(),bucket,key,body,'application/zip',f"{name} package")
+    else:
+        log("INFO",f" - {name} package would be staged at s3://{bucket}/{key}")
+    code.clear()
+    code.update({ "S3Bucket" : bucket, "S3Key" : key })
+    return True
+
+def syncCode(cloudFormation,args,s3 = None):
+    updated = []
+    cache = readSyncCache(args.cf)
 
-        log("WARNING",f"Updating properties for {name}.{KEY} = {VALUE}")
-        cloudFormation['Resources'][name]['Properties'][KEY] = VALUE
-        
     # == Update the code for all Lambda function
-    for name in cloudFormation['Resources']:
-        if cloudFormation['Resources'][name]['Type'] == 'AWS::Lambda::Function' and args.nocode == False:
-            log("INFO",f"Lambda code update for {name}")
-            if os.path.exists(f"{name}.py"):
-                log("INFO",f" - Found {name}.py - Updating")
-                # TODO - if the file is too big, Lambda will not update it
-                pc = []
-                with open(f"{name}.py",'rt') as C:
-                    for x in C.readlines():
-                        pc.append(x.replace('\n',''))
-                    cloudFormation['Resources'][name]['Properties']['Code']['ZipFile'] =  { "Fn::Join": ["\n", pc ]}
+    if args.nocode == False:
+        updated += syncLambdas(cloudFormation,args,cache,s3)
+
+    updated += syncUserData(cloudFormation,cache)
+
+    # -- forget about the files of resources that have since been removed
+    for name in [n for n in cache if not n in cloudFormation['Resources']]:
+        del cache[name]
+
+    if not args.dryrun:
+        writeSyncCache(args.cf,cache)
+
+    return updated
+
+@timed('code_sync')
+def syncLambdas(cloudFormation,args,cache,s3 = None):
+    updated = []
+    client = []
+    def s3client():
+        # -- only connect to S3 when there is something to upload
+        if not client:
+            boto3 = importBoto3()
+            client.append(s3 or boto3.client('s3'))
+        return client[0]
+
+    for name in findResources(cloudFormation,'AWS::Lambda::Function'):
+        log("INFO",f"Lambda code update for {name}")
+        code = cloudFormation['Resources'][name]['Properties']['Code']
+        # -- {name}.py wins over a {name} directory
+        source = f"{name}.py" if os.path.exists(f"{name}.py") else name if os.path.isdir(name) else None
+        if source == name and not args.stagingbucket:
+            log("WARNING",f" - {name} is a directory, so it has to be uploaded to S3 - use -stagingbucket to say where.  Not updating {name}")
+        elif source and args.stagingbucket and (source == name or os.path.getsize(source) > LAMBDA_ZIPFILE_LIMIT):
+            # -- too big to put in the template, so it goes to S3 as a zip
+            if syncPackage(cloudFormation,name,source,code,args.stagingbucket,s3client,cache,not args.dryrun):
+                log("INFO",f" - Found {source} - Updating")
+                updated.append(name)
             else:
-                log("WARNING",f' - Create a file called {name}.py to cause cfh to update the code automatically')
+                log("INFO",f" - {source} is unchanged")
+        elif source:
+            if os.path.getsize(f"{name}.py") > LAMBDA_ZIPFILE_LIMIT:
+                log("WARNING",f" - {name}.py is over the {LAMBDA_ZIPFILE_LIMIT} bytes CloudFormation accepts inline - use -stagingbucket to upload it to S3 instead")
+            pc = syncSource(cloudFormation,name,f"{name}.py",joinedLines(code.get('ZipFile')),cache)
+            if pc == None:
+                log("INFO",f" - {name}.py is unchanged")
+            else:
+                log("INFO",f" - Found {name}.py - Updating")
+                code.pop('S3Bucket',None)
+                code.pop('S3Key',None)
+                code['ZipFile'] =  { "Fn::Join": ["\n", pc ]}
+                updated.append(name)
+        else:
+            log("WARNING",f' - Create a file called {name}.py (or a {name} directory) to cause cfh to update the code automatically')
+
+    return updated
+
+@timed('userdata_sync')
+def syncUserData(cloudFormation,cache):
+    updated = []
 
     # == Update EC2 Launch Template UserData
-    for name in cloudFormation['Resources']:
-        if os.path.exists(f"{name}.sh"):
-            pc = []
-            with open(f"{name}.sh",'rt') as C:
-                for x in C.readlines():
-                    pc.append(x.replace('\n',''))
-
-            if cloudFormation['Resources'][name]['Type'] == 'AWS::EC2::LaunchTemplate':
-                log("INFO",f"Found {name}.sh - Updating Launch Template User Data {name}")
-                cloudFormation['Resources'][name]['Properties']['LaunchTemplateData']['UserData'] = { "Fn::Base64": {"Fn::Join": [ "\n", pc ] } }
-            if cloudFormation['Resources'][name]['Type'] == 'AWS::EC2::Instance':
-                log("INFO",f"Found {name}.sh - Updating EC2 User Data {name}")
-                cloudFormation['Resources'][name]['Properties']['UserData'] = { "Fn::Base64": {"Fn::Join": [ "\n", pc ] } }
+    for name in findResources(cloudFormation,'AWS::EC2::LaunchTemplate'):
+        if not os.path.exists(f"{name}.sh"):
+            continue
+        data = cloudFormation['Resources'][name]['Properties']['LaunchTemplateData']
+        pc = syncSource(cloudFormation,name,f"{name}.sh",userDataLines(data),cache)
+        if pc != None:
+            log("INFO",f"Found {name}.sh - Updating Launch Template User Data {name}")
+            data['UserData'] = { "Fn::Base64": {"Fn::Join": [ "\n", pc ] } }
+            updated.append(name)
+
+    # == Update EC2 UserData
+    for name in findResources(cloudFormation,'AWS::EC2::Instance'):
+        if not os.path.exists(f"{name}.sh"):
+            continue
+        properties = cloudFormation['Resources'][name]['Properties']
+        pc = syncSource(cloudFormation,name,f"{name}.sh",userDataLines(properties),cache)
+        if pc != None:
+            log("INFO",f"Found {name}.sh - Updating EC2 User Data {name}")
+            properties['UserData'] = { "Fn::Base64": {"Fn::Join": [ "\n", pc ] } }
+            updated.append(name)
+
+    return updated
+
+def applyOperations(cloudFormation,args):
+    # -- set the Description, if the user wanted it to
+    if args.desc:
+        cloudFormation['Description'] = args.desc
+
+    # == add resources to the file
+    if args.add:
+        addResource(cloudFormation,args)
+
+    # == Add properties
+    if args.properties:
+        updateProperties(cloudFormation,args)
 
     # == link resources to each other
     if args.link:
-        if not args.link[0] in cloudFormation['Parameters'] and not args.link[0] in cloudFormation['Resources']:
-            log("FATAL",f"Cannot link {args.link[0]} - it does not exist")
-        if not args.link[1] in cloudFormation['Resources']:
-            log("FATAL",f"Cannot link {args.link[1]} - it does not exist")
-
-        if args.link[0] in cloudFormation['Parameters'] and args.link[1] in cloudFormation['Resources']:
-            if cloudFormation['Resources'][args.link[1]]['Type'] == 'AWS::Lambda::Function':
-                log("INFO",f"Linking Parameter ({args.link[0]}) to Lambda ({args.link[1]})")
-                cloudFormation['Resources'][args.link[1]]['Properties']['Environment']['Variables'][args.link[0]] = { "Ref" : args.link[0] } 
-
-        if args.link[0] in cloudFormation['Resources'] and args.link[1] in cloudFormation['Resources']:
-            # -- linking s3 to ec2
-            if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::S3::Bucket' and cloudFormation['Resources'][args.link[1]]['Type'] == 'AWS::EC2::Instance':
-                log("INFO",f"Linking S3 ({args.link[0]}) to EC2 Role ({args.link[1]})")
-                x = cloudFormation['Resources'][f"{args.link[1]}ec2Role"]['Properties']['AssumeRolePolicyDocument']['Statement']
-                
-                p = resourceTemplate(None, 'policys3bucket', Bucket = args.link[0])
-                
-                if not p in x:
-                    log("WARNING","Updating policy")
-                    x.append(p)
-                else:
-                    log("INFO","Policy unchanged")
+        linkResources(cloudFormation,args)
 
-            # -- linking x to lambda
-            if cloudFormation['Resources'][args.link[1]]['Type'] == 'AWS::Lambda::Function':
-                
-                # -- find the Lambda execution policy
-                ExecutionRole = cloudFormation['Resources'][args.link[1]]['Properties']['Role']['Fn::GetAtt'][0]
-                # -- update the Lambda Execution Role policy
-                x = cloudFormation['Resources'][ExecutionRole]['Properties']['Policies'][0]['PolicyDocument']['Statement']
-
-                if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::DynamoDB::Table':
-                    log("INFO",f"Linking DynamoDb ({args.link[0]}) to Lambda ({args.link[1]})")
-                    p = resourceTemplate(None, 'policydynamodb', TableName = args.link[0])
-
-                if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::S3::Bucket':
-                    log("INFO",f"Linking S3 ({args.link[0]}) to Lambda ({args.link[1]})")
-                    p = resourceTemplate(None, 'policys3bucket', Bucket = args.link[0])
-
-                if cloudFormation['Resources'][args.link[0]]['Type'] == 'AWS::SSM::Parameter':
-                    log("INFO",f"Linking SSM Parameter ({args.link[0]}) to Lambda ({args.link[1]})")
-                    p = resourceTemplate(None, 'policyssmparameter', parameter = args.link[0])
-
-                if not p in x:
-                    log("WARNING","Updating policy")
-                    x.append(p)
-                else:
-                    log("INFO","Policy unchanged")
-                
-                # -- update the Lambda variable
-                cloudFormation['Resources'][args.link[1]]['Properties']['Environment']['Variables'][args.link[0]] = { "Ref" : args.link[0] } 
-
-                # -- Add it into the DependsOn (if it's not already there)
-                if args.link[0] not in cloudFormation['Resources'][args.link[1]]['DependsOn']:
-                    cloudFormation['Resources'][args.link[1]]['DependsOn'].append(args.link[0])
-
-            #else:
-                #log("FATAL","Unsupported linking direction")
-
-        
-    #print(json.dumps(cloudFormation, indent=4))
-
-    log("INFO",f"Writing {args.cf}")
-    result = json.dumps(cloudFormation,indent=4)
-    with open(args.cf,"wt") as Q:
-        Q.write(result)
-
-    if args.updatestack:
-        Parameters = []
-        for ParameterKey in cloudFormation['Parameters']:
-            Parameters.append({
-                "ParameterKey" : ParameterKey,
-                "UsePreviousValue" : True
-            })
-        
-        log("WARNING","====================================================================")
-        log("WARNING",f"UPDATING CLOUDFORMATION STACK - {args.updatestack}")
-        response = boto3.client('cloudformation').update_stack(  
-            StackName = args.updatestack,
-            TemplateBody = result,  
-            Capabilities = ['CAPABILITY_IAM'],
-            Parameters = Parameters
-        )
-        if 'StackId' in response:
-            log("INFO",response['StackId'])
+    # == remove the DependsOn entries that are not needed
+    if args.prune:
+        pruneDependsOn(cloudFormation)
+
+# -- options that are about the whole run (how the template is read, written, synced or deployed), so they only
+# -- work on the command line, and not on a script line
+RUN_OPTIONS = ['script','plugin','updatestack','targets','workers','changeset','deploytimeout','stagingbucket','validate','dryrun',
+    'benchmark','format','indent','export','sync','nocode','merge','locktimeout','profile','pstats']
+
+@timed('script')
+def runScript(cloudFormation,parser,args):
+    if args.script == '-':
+        log("INFO","Reading operations from stdin")
+        lines = sys.stdin.readlines()
+    else:
+        if not os.path.exists(args.script):
+            log("FATAL",f"Script file {args.script} does not exist")
+        log("INFO",f"Reading operations from {args.script}")
+        with open(args.script,'rt') as S:
+            lines = S.readlines()
+
+    for n,line in enumerate(lines,1):
+        tokens = shlex.split(line,comments = True)
+        if not tokens:
+            continue
+
+        # -- lines may be copied straight out of a shell script, so drop the "python cfh.py" prefix if it is there
+        while tokens and not tokens[0].startswith('-'):
+            tokens.pop(0)
+
+        log("",f"Script line {n} : {' '.join(tokens)}")
+        op = parser.parse_args(['-cf',args.cf] + tokens)
+        if op.cf != args.cf:
+            log("FATAL",f"Script line {n} targets {op.cf} - a script can only update {args.cf}")
+        given = [f"-{o}" for o in RUN_OPTIONS if getattr(op,o) != parser.get_default(o)]
+        if given:
+            log("FATAL",f"Script line {n} - {', '.join(given)} can only be used on the command line")
+
+        if op.list:
+            listResources(cloudFormation,op.list)
+        applyOperations(cloudFormation,op)
+
+TEMPLATE_BODY_LIMIT = 51200
+
+def stagedObject(staging,sha256,extension):
+    # -- where a file with this hash lives in the staging bucket, as (bucket,key)
+    bucket,_,prefix = staging.partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return bucket,f"{prefix}{sha256}.{extension}"
+
+def stageObject(s3,bucket,key,body,ContentType,what):
+    # -- the key is the hash of the body, so if it is already there, we don't upload it again
+    from botocore.exceptions import ClientError
+
+    try:
+        s3.head_object(Bucket = bucket,Key = key)
+        log("INFO",f"{what} is already staged at s3://{bucket}/{key}")
+    except ClientError as e:
+        if e.response.get('Error',{}).get('Code') not in ['404','NoSuchKey','NotFound']:
+            raise
+        log("INFO",f"Staging {what.lower()} at s3://{bucket}/{key}")
+        s3.put_object(Bucket = bucket,Key = key,Body = body,ContentType = ContentType)
+
+def stageTemplate(s3,staging,body):
+    # -- upload the template to s3://{bucket}/{prefix}{sha256}.json and return its URL
+    bucket,key = stagedObject(staging,hashlib.sha256(body.encode('utf-8')).hexdigest(),'json')
+    stageObject(s3,bucket,key,body.encode('utf-8'),'application/json','Template')
+
+    region = s3.meta.region_name
+    if region in [None,'us-east-1']:
+        return f"https://{bucket}.s3.amazonaws.com/{key}"
+    return f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
+
+def stackTemplate(cloudFormation,staging,s3):
+    # -- the template and parameter arguments for update_stack / create_change_set
+    # -- CloudFormation doesn't care what the template looks like, so send the smallest version of it
+    body = serializeTemplate(cloudFormation,'template.json','compact')
+    size = len(body.encode('utf-8'))
+    if size > TEMPLATE_BODY_LIMIT and not staging:
+        log("FATAL",f"The template is {size} bytes - anything over {TEMPLATE_BODY_LIMIT} bytes has to go through S3.  Use -stagingbucket to say where.")
+    log("INFO",f"Template size : {size} bytes")
+
+    Parameters = []
+    for ParameterKey in cloudFormation['Parameters']:
+        Parameters.append({
+            "ParameterKey" : ParameterKey,
+            "UsePreviousValue" : True
+        })
+
+    if size > TEMPLATE_BODY_LIMIT:
+        template = { "TemplateURL" : stageTemplate(s3(),staging,body) }
+    else:
+        template = { "TemplateBody" : body }
+
+    template['Capabilities'] = ['CAPABILITY_IAM']
+    template['Parameters'] = Parameters
+    return template
+
+def updateStack(cloudFormation,stackName,staging = None,cloudformation = None,s3 = None,template = None):
+    # -- boto3 is slow to import, and only needed here, so leave it until we actually talk to AWS
+    boto3 = importBoto3()
+
+    log("WARNING","====================================================================")
+    log("WARNING",f"UPDATING CLOUDFORMATION STACK - {stackName}")
+    template = template or stackTemplate(cloudFormation,staging,lambda : s3 or boto3.client('s3'))
+
+    response = (cloudformation or boto3.client('cloudformation')).update_stack(
+        StackName = stackName,
+        **template
+    )
+    if 'StackId' in response:
+        log("INFO",response['StackId'])
+    else:
+        print(response)
+    log("WARNING","====================================================================")
+
+STACK_DONE = ['UPDATE_COMPLETE','UPDATE_FAILED','UPDATE_ROLLBACK_COMPLETE','UPDATE_ROLLBACK_FAILED']
+
+def waitFor(check,sleep,first = 2,longest = 30,timeout = None):
+    # -- call check() until it returns something, backing off exponentially between calls.  Returns None if
+    # -- check() still had nothing after sleeping for timeout seconds
+    delay = first
+    waited = 0
+    while True:
+        result = check()
+        if result != None:
+            return result
+        if timeout != None and waited >= timeout:
+            return None
+        if timeout != None:
+            delay = min(delay,timeout - waited)
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2,longest)
+
+def stackEvents(cloudformation,stackName,seen):
+    # -- the events we haven't seen yet, oldest first.  describe_stack_events returns the newest first, so we
+    # -- can stop paging as soon as we hit an event we have already seen
+    events = []
+    kwargs = { "StackName" : stackName }
+    while True:
+        page = cloudformation.describe_stack_events(**kwargs)
+        for event in page['StackEvents']:
+            if event['EventId'] in seen:
+                break
+            events.append(event)
+        else:
+            if page.get('NextToken'):
+                kwargs['NextToken'] = page['NextToken']
+                continue
+        break
+
+    events.reverse()
+    for event in events:
+        seen.add(event['EventId'])
+    return events
+
+def deployChangeSet(cloudFormation,stackName,staging = None,cloudformation = None,s3 = None,sleep = time.sleep,template = None,timeout = 3600):
+    # -- update the stack through a change set, show what will change, and follow the stack events until the
+    # -- update is done.  Returns True if the stack was updated (or had nothing to update).  We give up after
+    # -- timeout seconds of waiting - the update carries on in CloudFormation, but we stop following it
+    boto3 = importBoto3()
+
+    cloudformation = cloudformation or boto3.client('cloudformation')
+    log("WARNING","====================================================================")
+    log("WARNING",f"UPDATING CLOUDFORMATION STACK - {stackName} (change set)")
+    template = template or stackTemplate(cloudFormation,staging,lambda : s3 or boto3.client('s3'))
+
+    changeSetName = f"cfh-{time.strftime('%Y%m%d%H%M%S',time.gmtime())}"
+    cloudformation.create_change_set(
+        StackName = stackName,
+        ChangeSetName = changeSetName,
+        ChangeSetType = 'UPDATE',
+        **template
+    )
+    log("INFO",f"Created change set {changeSetName} - waiting for it to be ready")
+
+    def changeSetReady():
+        response = cloudformation.describe_change_set(StackName = stackName,ChangeSetName = changeSetName)
+        if response['Status'] in ['CREATE_COMPLETE','FAILED']:
+            return response
+    # -- the timeout covers the wait for the change set and the update together
+    waited = [0]
+    def pause(seconds):
+        sleep(seconds)
+        waited[0] += seconds
+    response = waitFor(changeSetReady,pause,timeout = timeout)
+
+    if response == None or response['Status'] == 'FAILED':
+        # -- a change set that is not going to be executed is only clutter in the stack
+        cloudformation.delete_change_set(StackName = stackName,ChangeSetName = changeSetName)
+        if response == None:
+            log("ERROR",f"Change set {changeSetName} was not ready after {timeout} seconds - deleted it")
+            return False
+        reason = response.get('StatusReason','')
+        if "didn't contain changes" in reason or "No updates are to be performed" in reason:
+            log("INFO","There is nothing to update")
+            log("WARNING","====================================================================")
+            return True
+        log("ERROR",f"Change set failed - {reason}")
+        return False
+
+    # == what is going to change
+    changes = response['Changes']
+    while response.get('NextToken'):
+        response = cloudformation.describe_change_set(StackName = stackName,ChangeSetName = changeSetName,NextToken = response['NextToken'])
+        changes += response['Changes']
+
+    summary = {}
+    for change in changes:
+        c = change['ResourceChange']
+        summary[c['Action']] = summary.get(c['Action'],0) + 1
+        replace = ''
+        if c.get('Replacement') in ['True','Conditional']:
+            replace = ' - REPLACEMENT' if c['Replacement'] == 'True' else ' - conditional replacement'
+        log("INFO",f" {c['Action']:<8} {c['LogicalResourceId']} ({c['ResourceType']}){replace}")
+    log("INFO",', '.join(f"{n} to {a.lower()}" for a,n in summary.items()))
+
+    # == anything that happened before now is old news - the first page is enough, as we stop at the first event we've seen
+    seen = set(event['EventId'] for event in cloudformation.describe_stack_events(StackName = stackName)['StackEvents'])
+
+    cloudformation.execute_change_set(StackName = stackName,ChangeSetName = changeSetName)
+    log("INFO","Executing the change set")
+
+    # == follow the stack events until the stack update is finished.  Back off while nothing is happening,
+    # == and start polling quickly again as soon as it is
+    status = None
+    delay = 2
+    while not status:
+        events = stackEvents(cloudformation,stackName,seen)
+        for event in events:
+            log("INFO",f" {event['Timestamp']} {event['ResourceStatus']:<30} {event['LogicalResourceId']} {event.get('ResourceStatusReason','')}")
+            if event['ResourceType'] == 'AWS::CloudFormation::Stack' and event.get('PhysicalResourceId') == event.get('StackId') and event['ResourceStatus'] in STACK_DONE:
+                status = event['ResourceStatus']
+        if not status:
+            if waited[0] >= timeout:
+                log("ERROR",f"Stack {stackName} is still updating after {timeout} seconds - no longer following it")
+                log("WARNING","====================================================================")
+                return False
+            delay = min(delay,timeout - waited[0])
+            pause(delay)
+            delay = 2 if events else min(delay * 2,30)
+
+    log("WARNING",f"Stack {stackName} - {status}")
+    log("WARNING","====================================================================")
+    return status == 'UPDATE_COMPLETE'
+
+def readTargets(file):
+    # -- one target per line - profile region stack.  Use - for the default profile or region, and leave the
+    # -- stack out to use the one given with -updatestack
+    if not os.path.exists(file):
+        log("FATAL",f"Targets file {file} does not exist")
+    targets = []
+    for n,line in enumerate(readText(file).splitlines(),1):
+        t = shlex.split(line,comments = True)
+        if not t:
+            continue
+        if len(t) not in [2,3]:
+            log("FATAL",f"{file} line {n} - expected <profile> <region> [stack]")
+        targets.append([None if x == '-' else x for x in t] + [None] * (3 - len(t)))
+    if not targets:
+        log("FATAL",f"There are no targets in {file}")
+    return targets
+
+def deployTargets(cloudFormation,targets,stackName = None,staging = None,changeset = False,workers = 10,session = None,timeout = 3600):
+    # -- deploy the template to many stacks at once.  There is one session per profile, and one client per profile
+    # -- and region, which the updates share.  Returns True if every update worked
+    boto3 = importBoto3()
+    from concurrent.futures import ThreadPoolExecutor
+
+    session = session or boto3.Session
+    sessions = {}
+    clients = {}
+    for profile,region,stack in targets:
+        if not stack and not stackName:
+            log("FATAL",f"No stack given for {profile or 'default'} / {region or 'default'} - add it to the targets file or use -updatestack")
+        if not profile in sessions:
+            sessions[profile] = session(profile_name = profile)
+        if not (profile,region) in clients:
+            clients[(profile,region)] = sessions[profile].client('cloudformation',region_name = region)
+
+    # -- the template (and the S3 staging, if it is needed) is the same for all of them.  It is staged with the first
+    # -- target's profile, so every other account has to be able to read the staging bucket
+    template = stackTemplate(cloudFormation,staging,lambda : sessions[targets[0][0]].client('s3'))
+
+    def deploy(target):
+        profile,region,stack = target
+        stack = stack or stackName
+        start = time.monotonic()
+        LOG.prefix = f"{profile or 'default'}/{region or 'default'}/{stack} : "
+        try:
+            if changeset:
+                result = 'UPDATED' if deployChangeSet(cloudFormation,stack,cloudformation = clients[(profile,region)],template = template,timeout = timeout) else 'FAILED'
+            else:
+                clients[(profile,region)].update_stack(StackName = stack,**template)
+                result = 'UPDATE STARTED'
+        except Exception as e:
+            result = 'NO CHANGES' if 'No updates are to be performed' in str(e) else f"FAILED - {e}"
+        except SystemExit:
+            result = 'FAILED'
+        return [profile or 'default',region or 'default',stack,result,f"{time.monotonic() - start:.1f}"]
+
+    log("WARNING","====================================================================")
+    log("WARNING",f"UPDATING {len(targets)} CLOUDFORMATION STACKS")
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        results = list(pool.map(deploy,targets))
+
+    headings = ['Profile','Region','Stack','Result','Seconds']
+    widths = [max(len(str(r[i])) for r in results + [headings]) for i in range(len(headings))]
+    for r in [headings] + results:
+        print('  '.join(str(v).ljust(w) for v,w in zip(r,widths)))
+    log("WARNING","====================================================================")
+
+    return all(not r[3].startswith('FAILED') for r in results)
+
+@contextlib.contextmanager
+def templateLock(cf,timeout):
+    # -- an advisory lock so parallel runs against the same template take turns.  We lock a file named after the
+    # -- template's real path in the temp folder, and not the template itself, because the template is replaced (not
+    # -- rewritten) every time it is written.  The lock file is left there, as removing it would let a run that is
+    # -- waiting for it and a new run both think they have the lock
+    lockfile = os.path.join(tempfile.gettempdir(),f"cfh-{hashlib.sha256(os.path.realpath(cf).encode('utf-8')).hexdigest()[:16]}.lock")
+    with open(lockfile,'a') as L:
+        with phase('lock'):
+            start = time.monotonic()
+            waiting = False
+            while True:
+                try:
+                    if fcntl:
+                        fcntl.flock(L.fileno(),fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    else:
+                        L.seek(0)
+                        msvcrt.locking(L.fileno(),msvcrt.LK_NBLCK,1)
+                    break
+                except OSError:
+                    if time.monotonic() - start >= timeout:
+                        log("FATAL",f"Timed out after {timeout} seconds waiting for the lock on {cf}")
+                    if not waiting:
+                        log("INFO",f"Waiting for another cfh.py to finish with {cf}...")
+                        waiting = True
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(L.fileno(),fcntl.LOCK_UN)
+            else:
+                L.seek(0)
+                msvcrt.locking(L.fileno(),msvcrt.LK_UNLCK,1)
+
+MISSING = object()
+
+def mergeTemplates(base,ours,theirs,path = ''):
+    # -- three way merge of our changes (base -> ours) into theirs.  Returns the merged template and a list of
+    # -- the places where both sides made different changes.  Lists that both sides only appended to are combined.
+    merged = {}
+    conflicts = []
+    for key in list(theirs) + [k for k in ours if not k in theirs]:
+        b = base.get(key,MISSING)
+        o = ours.get(key,MISSING)
+        t = theirs.get(key,MISSING)
+        if o == t or o == b:
+            value = t
+        elif t == b:
+            value = o
+        elif isinstance(o,dict) and isinstance(t,dict):
+            value,c = mergeTemplates(b if isinstance(b,dict) else {},o,t,f"{path}/{key}")
+            conflicts += c
+        elif isinstance(o,list) and isinstance(t,list) and (b is MISSING or isinstance(b,list)):
+            b = [] if b is MISSING else b
+            if key in ['SecurityGroupIngress','SecurityGroupEgress']:
+                # -- adding a rule can merge it into the existing ones, so put both sets of rules together and merge them again
+                value = collapseRules(t + [x for x in o if not x in t])
+            elif o[:len(b)] == b and t[:len(b)] == b:
+                value = t + [x for x in o[len(b):] if not x in t[len(b):]]
+            else:
+                conflicts.append(f"{path}/{key}")
+                value = t
         else:
-            print(response)
-        log("WARNING","====================================================================")
+            conflicts.append(f"{path}/{key}")
+            value = t
+        if value is not MISSING:
+            merged[key] = value
+    return merged,conflicts
+
+@timed('merge')
+def mergeTemplate(args,cloudFormation,result,original):
+    # -- if someone else wrote the template since we read it, merge our changes into their version
+    cf = args.cf
+    latest = readText(cf)
+    if latest == original:
+        return cloudFormation,result,original
+
+    log("WARNING",f"{cf} was changed by someone else - merging our changes into it")
+    merged,conflicts = mergeTemplates(
+        parseTemplate(original,cf) if original else {},
+        parseTemplate(result,cf),
+        parseTemplate(latest,cf) if latest else {}
+    )
+    if conflicts:
+        for c in conflicts:
+            log("ERROR",f" - conflict at {c}")
+        log("FATAL",f"Unable to merge our changes into {cf} - nothing was written")
+
+    qaTemplate(merged)
+    return merged,serializeTemplate(merged,cf,args.format,args.indent),latest
+
+def pointer(path,key):
+    # -- JSON pointer (RFC 6901) to key inside path
+    return f"{path}/{str(key).replace('~','~0').replace('/','~1')}"
+
+def changedPaths(before,after,path):
+    # -- JSON pointers to everything that is different between before and after
+    if isinstance(before,dict) and isinstance(after,dict):
+        paths = []
+        for key in list(before) + [k for k in after if not k in before]:
+            if not key in after or not key in before:
+                paths.append(pointer(path,key))
+            elif before[key] != after[key]:
+                paths += changedPaths(before[key],after[key],pointer(path,key))
+        return paths
+    if isinstance(before,list) and isinstance(after,list):
+        paths = []
+        for i in range(max(len(before),len(after))):
+            if i >= len(before) or i >= len(after):
+                paths.append(pointer(path,i))
+            elif before[i] != after[i]:
+                paths += changedPaths(before[i],after[i],pointer(path,i))
+        return paths
+    return [path]
+
+def diffTemplates(before,after):
+    # -- what changed between two templates, one entry per resource (or parameter, output, ...) as
+    # -- [action,pointer,type,changed paths].  Entries are compared with ==, which stops at the first difference,
+    # -- and only the ones that changed are walked to find the paths.
+    changes = []
+    unchanged = 0
+    for section in list(before) + [s for s in after if not s in before]:
+        b = before.get(section,{})
+        a = after.get(section,{})
+        if not isinstance(b,dict) or not isinstance(a,dict):
+            if b != a:
+                changes.append(['+' if not section in before else '-' if not section in after else '~',pointer('',section),'',[]])
+            continue
+        for name in list(b) + [n for n in a if not n in b]:
+            p = pointer(pointer('',section),name)
+            if not name in a:
+                changes.append(['-',p,b[name].get('Type','') if isinstance(b[name],dict) else '',[]])
+            elif not name in b:
+                changes.append(['+',p,a[name].get('Type','') if isinstance(a[name],dict) else '',[]])
+            elif b[name] == a[name]:
+                unchanged += 1
+            else:
+                changes.append(['~',p,a[name].get('Type','') if isinstance(a[name],dict) else '',changedPaths(b[name],a[name],p)])
+    return changes,unchanged
+
+def printDiff(changes,unchanged):
+    for action,path,type,paths in changes:
+        print(f"{action} {path:<60} {type}")
+        for p in paths:
+            print(f"      {p}")
+    count = lambda a : len([c for c in changes if c[0] == a])
+    log("INFO",f"{count('+')} added, {count('-')} removed, {count('~')} modified, {unchanged} unchanged")
+
+def updateTemplate(parser,args):
+    cloudFormation,original = loadTemplate(args.cf)
+
+    # -- set the Description, if the user wanted it to
+    if args.desc:
+        cloudFormation['Description'] = args.desc
+
+    qaTemplate(cloudFormation)
+
+    if args.script:
+        runScript(cloudFormation,parser,args)
+    applyOperations(cloudFormation,args)
+
+    updated = syncCode(cloudFormation,args)
+
+    # == report on the source files that were synced
+    if args.sync:
+        for name in updated:
+            log("INFO",f"Updated {name}")
+        if not updated:
+            log("INFO","All Lambda code and UserData is up to date")
+
+    with phase('serialize'):
+        result = serializeTemplate(cloudFormation,args.cf,args.format,args.indent)
+    return cloudFormation,result,original
+
+def main():
+    # -- plugins can add their own options, so they have to be loaded before the command line is parsed
+    pre = argparse.ArgumentParser(add_help = False)
+    pre.add_argument('-plugin',action='append',default=[])
+    plugins = [p for p in os.environ.get('CFH_PLUGINS','').split(',') if p] + pre.parse_known_args()[0].plugin
+    if plugins:
+        with phase('plugins'):
+            loadPlugins(plugins)
+
+    parser = buildParser()
+    args = parser.parse_args()
+
+    # -- everything is timed anyway - -profile reports it, and -pstats adds a full cProfile of the run
+    profiler = None
+    if args.pstats:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        run(parser,args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.pstats)
+        if args.profile:
+            reportProfile(args.profile,args.cf,time.perf_counter() - start)
+
+def run(parser,args):
+    # == list resources (the template is never half written, so there is no need to lock it just to read it)
+    if args.list and not args.script:
+        cloudFormation,original = loadTemplate(args.cf)
+        qaTemplate(cloudFormation)
+        listResources(cloudFormation,args.list)
+        exit(0)
+
+    if args.validate:
+        cloudFormation,original = loadTemplate(args.cf)
+        qaTemplate(cloudFormation)
+        exit(0 if validateTemplate(cloudFormation) else 1)
+
+    if args.benchmark:
+        cloudFormation,original = loadTemplate(args.cf)
+        qaTemplate(cloudFormation)
+        benchmark(cloudFormation,args.benchmark)
+        exit(0)
+
+    # -- read the targets first, so a bad targets file stops us before the template is touched
+    targets = readTargets(args.targets) if args.targets else None
+
+    # == show what would change, without writing anything
+    if args.dryrun:
+        cloudFormation,result,original = updateTemplate(parser,args)
+        with phase('diff'):
+            printDiff(*diffTemplates(parseTemplate(original,args.cf) if original else {},cloudFormation))
+        exit(0)
+
+    if args.merge:
+        # -- make our changes without holding the lock, and merge them into whatever is there when it is our turn to write
+        cloudFormation,result,original = updateTemplate(parser,args)
+        with templateLock(args.cf,args.locktimeout):
+            cloudFormation,result,original = mergeTemplate(args,cloudFormation,result,original)
+            writeTemplate(args.cf,result,original)
+    else:
+        with templateLock(args.cf,args.locktimeout):
+            cloudFormation,result,original = updateTemplate(parser,args)
+            writeTemplate(args.cf,result,original)
+
+    # -- a compact copy, for deployment
+    if args.export:
+        with phase('serialize'):
+            result = serializeTemplate(cloudFormation,args.export,'compact')
+        writeTemplate(args.export,result,readText(args.export))
+
+    if args.targets or args.updatestack:
+        with phase('deploy'):
+            if args.targets:
+                if not deployTargets(cloudFormation,targets,args.updatestack,args.stagingbucket,args.changeset,args.workers,timeout = args.deploytimeout):
+                    exit(1)
+            elif args.changeset:
+                if not deployChangeSet(cloudFormation,args.updatestack,args.stagingbucket,timeout = args.deploytimeout):
+                    exit(1)
+            else:
+                updateStack(cloudFormation,args.updatestack,args.stagingbucket)
 
 if __name__ == '__main__':
     main()
@@ -1,63 +1,268 @@
 import argparse
-from zipfile import ZipFile
+import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 import boto3
-import io
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import fnmatch
+import hashlib
 import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 
-def main():
-    parser = argparse.ArgumentParser(description='Update Lambda function')
-    parser.add_argument('-fn', help='Function name', required=True)
-    parser.add_argument('-files',help='List of files to combine into a package',nargs='+', required=True)
-    parser.add_argument('-s3',help='The S3 bucket to be used as staging (for larger lambda functions)')
-    args = parser.parse_args()
+# -- packages shared by several functions (in bulk mode) go in this folder instead of the folder of one of them
+SHARED = '_shared'
+
+# -- every file gets the same timestamp, so the same files always give the same zip
+FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+# -- cfh.py has its own copy of EXCLUDE, excluded, packageFiles and buildPackage (PACKAGE_EXCLUDE, packageExcluded,
+# -- packageFiles and packageLambda) - keep them the same, so both give the same zip for the same directory
+EXCLUDE = ['__pycache__', '*.pyc', '.git', 'tests']
+
+def excluded(name, exclude):
+    # -- a path is excluded if it, or any of its folders, matches one of the globs
+    parts = name.split('/')
+    return any(fnmatch.fnmatch(name, e) or any(fnmatch.fnmatch(p, e) for p in parts) for e in exclude)
 
-    obj = io.BytesIO()
-    with ZipFile(obj, 'w') as zip_object:
-        row = 0
-        for f in args.files:
-            if os.path.isdir(f):
-                print(f"{f} is a folder")
-                for r, d, F in os.walk(f):
-                    for file in F:
-                        x = os.path.join(r, file)[len(f)+1:]
-                        print(f" - Zipping -- {f}/{x}")
-                        zip_object.write(f"{f}/{x}",x)
-                        #print(x)
+def packageFiles(files, exclude):
+    # -- (path, name in the zip) for everything that goes in the package.  The first file becomes index.py,
+    # -- and folders are added in sorted order, so the package is the same no matter what order the disk returns them in
+    package = []
+    row = 0
+    for f in files:
+        if os.path.isdir(f):
+            print(f"{f} is a folder")
+            found = []
+            for r, d, F in os.walk(f):
+                d[:] = [x for x in d if not excluded(os.path.relpath(os.path.join(r, x), f).replace(os.sep, '/'), exclude)]
+                for file in F:
+                    x = os.path.relpath(os.path.join(r, file), f).replace(os.sep, '/')
+                    if not excluded(x, exclude):
+                        found.append((f"{f}/{x}", x))
+            package += sorted(found, key=lambda p: p[1])
+        else:
+            if row == 0:
+                filename = 'index.py'
             else:
-                # Adding files that need to be zipped
-                print(f" - Zipping -- {f}")
-                if row == 0:
-                    filename = 'index.py'
-                else:
-                    filename = f
-                
-                zip_object.write(f,filename)
-                row += 1
-    
-    # -- update the lambda function's code
-    if not args.s3:
-        response = boto3.client('lambda').update_function_code(
-            FunctionName=args.fn,
-            ZipFile=obj.getvalue(),
+                filename = f
+            package.append((f, filename))
+            row += 1
+    return package
+
+def buildPackage(files, obj, exclude=EXCLUDE, level=6):
+    # -- write the zip to obj, with a fixed timestamp and permissions for every file, so the bytes (and the hash) only change when the code does
+    with ZipFile(obj, 'w', ZIP_DEFLATED, compresslevel=level) as zip_object:
+        for path, name in packageFiles(files, exclude):
+            print(f" - Zipping -- {path}")
+            info = ZipInfo(name, date_time=FIXED_DATE)
+            info.external_attr = (0o755 if os.access(path, os.X_OK) else 0o644) << 16
+            info.compress_type = ZIP_DEFLATED
+            # -- open() only takes the ZipFile's compression level for a name, not for a ZipInfo, so set it on the info
+            info._compresslevel = level
+            info.file_size = os.path.getsize(path)
+            # -- stream the file into the zip, so only a chunk of it is in memory at a time
+            with open(path, 'rb') as F, zip_object.open(info, 'w') as Z:
+                shutil.copyfileobj(F, Z, 1024 * 1024)
+    obj.seek(0)
+    return obj
+
+def codeSha256(obj):
+    # -- the hash Lambda reports as CodeSha256 - the base64 of the SHA-256 of the zip
+    h = hashlib.sha256()
+    obj.seek(0)
+    for chunk in iter(lambda: obj.read(1024 * 1024), b''):
+        h.update(chunk)
+    obj.seek(0)
+    return base64.b64encode(h.digest()).decode('ascii')
+
+class Progress:
+    # -- upload progress, printed every 10%.  boto3 calls this from each of the threads uploading a part
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+        self.done = 0
+        self.shown = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, sent):
+        with self.lock:
+            self.done += sent
+            percent = int(self.done * 100 / self.size) if self.size else 100
+            if percent >= self.shown + 10 or self.done == self.size:
+                self.shown = percent - percent % 10
+                print(f" - {self.key} : {self.done} of {self.size} bytes ({percent}%)")
+
+def stagedKey(fn, bucket, sha256):
+    # -- each function has its own folder, and the package is named after its hash, so functions don't overwrite each other's code
+    bucket, _, prefix = bucket.partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return bucket, f"{prefix}{fn}/{base64.b64decode(sha256).hex()}.zip"
+
+def stageCode(s3, bucket, key, obj, sha256, config=None):
+    # -- upload the package, unless the object is already there with the same hash.  Big packages are uploaded
+    # -- in parts, several at a time, as set in config (a TransferConfig)
+    try:
+        if s3.head_object(Bucket=bucket, Key=key).get('Metadata', {}).get('sha256') == sha256:
+            print(f"s3://{bucket}/{key} is already up to date")
+            return
+    except s3.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ['404', 'NoSuchKey', 'NotFound']:
+            raise
+    print(f"Uploading to s3://{bucket}/{key}...")
+    size = obj.seek(0, 2)
+    obj.seek(0)
+    s3.upload_fileobj(obj, bucket, key, ExtraArgs={'Metadata': {'sha256': sha256}}, Callback=Progress(key, size), Config=config)
+
+def updateFunction(lam, fn, obj, bucket=None, s3=None, force=False, config=None, stage=None):
+    # -- update the lambda function's code, unless it is already running this exact package.  Returns the
+    # -- update_function_code response, or None if nothing had to be done.  stage(fn, obj, sha256) can put the
+    # -- package somewhere else in S3, and return (bucket, key)
+    sha256 = codeSha256(obj)
+    if not force and lam.get_function(FunctionName=fn)['Configuration']['CodeSha256'] == sha256:
+        print(f"{fn} is already running this code ({sha256}) - not updating")
+        return None
+
+    if not bucket:
+        return lam.update_function_code(
+            FunctionName=fn,
+            ZipFile=obj.read(),
             Publish=True
         )
-        print(json.dumps(response,indent=4))
+
+    if stage:
+        S3Bucket, S3Key = stage(fn, obj, sha256)
     else:
-        print("Uploading to S3...")
-        S3Key = "f{args.fn}.zip"
-        obj.seek(0)
-        s3 = boto3.resource('s3').Bucket(args.s3).upload_fileobj(obj, S3Key)
-        response = boto3.client('lambda').update_function_code(
-            FunctionName=args.fn,
-            S3Bucket=args.s3,
-            S3Key=S3Key,
-            Publish=True
-        )
+        S3Bucket, S3Key = stagedKey(fn, bucket, sha256)
+        stageCode(s3, S3Bucket, S3Key, obj, sha256, config)
+    return lam.update_function_code(
+        FunctionName=fn,
+        S3Bucket=S3Bucket,
+        S3Key=S3Key,
+        Publish=True
+    )
+
+def buildFile(files, exclude=EXCLUDE, level=6):
+    # -- build a package in a temporary file, so it can be built in another process.  Returns (path, sha256, seconds)
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as obj:
+        buildPackage(files, obj, exclude, level)
+        sha256 = codeSha256(obj)
+    return obj.name, sha256, time.perf_counter() - start
+
+def bulkUpdate(manifest, lam, bucket=None, s3=None, force=False, config=None, exclude=EXCLUDE, level=6, workers=10, processes=None):
+    # -- update every function in the manifest { function : [ files ] }.  The packages are built in a process pool
+    # -- (each list of files only once), functions with identical packages share one upload, and the updates run in a
+    # -- thread pool with the same clients.  Returns True if every function was updated (or was already up to date)
+    packages = {}
+    staged = {}
+    lock = threading.Lock()
+    report = {fn: ['', 0.0, 0.0] for fn in manifest}
+
+    def stage(fn, obj, sha256):
+        # -- the first function with this package uploads it, the others wait for it and use the same object
+        with lock:
+            if sha256 not in staged:
+                staged[sha256] = [threading.Lock(), stagedKey(fn if users[sha256] == 1 else SHARED, bucket, sha256), False]
+            entry = staged[sha256]
+        with entry[0]:
+            if not entry[2]:
+                stageCode(s3, entry[1][0], entry[1][1], obj, sha256, config)
+                entry[2] = True
+        return entry[1]
+
+    def update(fn):
+        path, sha256, seconds = packages[tuple(manifest[fn])]
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as obj:
+                report[fn][0] = 'UNCHANGED' if updateFunction(lam, fn, obj, bucket, s3, force, config, stage) is None else 'UPDATED'
+        except Exception as e:
+            report[fn][0] = f"FAILED - {e}"
+        report[fn][1] = seconds
+        report[fn][2] = time.perf_counter() - start
+
+    try:
+        with ProcessPoolExecutor(processes) as pool:
+            unique = list({tuple(files) for files in manifest.values()})
+            for files, built in zip(unique, pool.map(buildFile, unique, [exclude] * len(unique), [level] * len(unique))):
+                packages[files] = built
+
+        # -- different lists of files that give the same package only need one copy of it
+        byHash = {}
+        for files, (path, sha256, seconds) in packages.items():
+            if sha256 in byHash:
+                os.remove(path)
+                packages[files] = (byHash[sha256], sha256, seconds)
+            else:
+                byHash[sha256] = path
+
+        # -- how many functions use each package - a package used by more than one is staged in the SHARED folder
+        users = {}
+        for fn in manifest:
+            sha256 = packages[tuple(manifest[fn])][1]
+            users[sha256] = users.get(sha256, 0) + 1
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(update, manifest))
+    finally:
+        for path in {p[0] for p in packages.values()}:
+            os.remove(path)
+
+    print(f"{'Function':<40} {'Build (s)':>10} {'Update (s)':>10}  Result")
+    for fn, (result, build, seconds) in report.items():
+        print(f"{fn:<40} {build:>10.2f} {seconds:>10.2f}  {result}")
+    return all(not r[0].startswith('FAILED') for r in report.values())
+
+def main():
+    parser = argparse.ArgumentParser(description='Update Lambda function')
+    parser.add_argument('-fn', help='Function name')
+    parser.add_argument('-files',help='List of files to combine into a package',nargs='+')
+    parser.add_argument('-manifest',help='JSON file with the files for many functions - { "function" : [ "file", ... ] }')
+    parser.add_argument('-workers',help='How many functions to update at the same time (with -manifest) - default 10',type=int,default=10)
+    parser.add_argument('-s3',help='The S3 bucket (and optional prefix, bucket/prefix) to be used as staging (for larger lambda functions)')
+    parser.add_argument('-threshold',help='Packages bigger than this (in MB) are uploaded to S3 in parts - default 8',type=int,default=8)
+    parser.add_argument('-chunk',help='Size of each part (in MB) - default 8',type=int,default=8)
+    parser.add_argument('-concurrency',help='How many parts to upload at the same time - default 10',type=int,default=10)
+    parser.add_argument('-level',help='Compression level, from 0 (none) to 9 (smallest) - default 6',type=int,choices=range(0,10),default=6)
+    parser.add_argument('-exclude',help=f'Files and folders to leave out of the package (default {" ".join(EXCLUDE)})',nargs='*',default=EXCLUDE)
+    parser.add_argument('-spill',help='Packages bigger than this (in MB) are built in a temporary file instead of in memory - default 64',type=int,default=64)
+    parser.add_argument('-force',help='Update the function (and publish a new version) even if the code has not changed',action='store_true')
+    args = parser.parse_args()
+    if not args.manifest and not (args.fn and args.files):
+        parser.error('use -fn and -files, or -manifest')
+
+    config = TransferConfig(
+        multipart_threshold=args.threshold * 1024 * 1024,
+        multipart_chunksize=args.chunk * 1024 * 1024,
+        max_concurrency=args.concurrency
+    )
+
+    # -- every function being updated at the same time can be uploading -concurrency parts at the same time, so the
+    # -- S3 client they share needs enough connections for all of them (and the Lambda client one for each function)
+    workers = args.workers if args.manifest else 1
+    s3 = boto3.client('s3', config=Config(max_pool_connections=workers * args.concurrency)) if args.s3 else None
+
+    if args.manifest:
+        with open(args.manifest) as M:
+            manifest = json.load(M)
+        lam = boto3.client('lambda', config=Config(max_pool_connections=args.workers))
+        if not bulkUpdate(manifest, lam, args.s3, s3, args.force, config, args.exclude, args.level, args.workers):
+            exit(1)
+        return
+
+    # -- the package is kept in memory, until it gets bigger than -spill
+    obj = buildPackage(args.files, tempfile.SpooledTemporaryFile(max_size=args.spill * 1024 * 1024), args.exclude, args.level)
+
+    response = updateFunction(boto3.client('lambda'), args.fn, obj, args.s3, s3, args.force, config)
+    if response:
         print(json.dumps(response,indent=4))
 
 if __name__ == '__main__':
     main()
 
 
-
@@ -1,10 +1,30 @@
+import hashlib
+import ipaddress
 import json
+import os
+import time
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 import urllib.request
 import urllib.parse
 
+# -- how many buckets to look at (and update) at the same time
+WORKERS = int(os.environ.get('WORKERS', '16'))
+
+# -- where the IP ranges from the last run are kept.  The execution role (updateCloudFlareIP.json) only allows
+# -- this one parameter, so if you change it, change the policy as well
+IP_PARAMETER = '/cloudflare/ips'
+
+def s3_client():
+    # -- one client for all the threads, that slows down by itself when S3 starts throttling us
+    return boto3.client('s3', config = Config(
+        retries = { 'max_attempts': 10, 'mode': 'adaptive' },
+        max_pool_connections = WORKERS
+    ))
+
 def findIps():
     req = urllib.request.Request(
         'https://api.cloudflare.com/client/v4/ips',
@@ -13,9 +33,42 @@ def findIps():
     )
     resp = urllib.request.urlopen(req)
     return json.loads(resp.read())
+
+def collapse_cidrs(cidrs):
+    # -- merge overlapping and adjacent ranges, and drop duplicates and ranges that are inside bigger ones, so the
+    # -- policy stays well under the 20 KB limit.  This is a copy of collapseCidrs in cfh.py - the Lambda function
+    # -- is a single file in the template, so it can't import it.  Keep the two the same
+    networks = [ipaddress.ip_network(c, strict=False) for c in cidrs]
+    return [str(n) for v in [4,6] for n in ipaddress.collapse_addresses([x for x in networks if x.version == v])]
+
+def ip_hash(ip):
+    return hashlib.sha256(json.dumps(sorted(ip['ipv4_cidrs']) + sorted(ip['ipv6_cidrs'])).encode('utf-8')).hexdigest()
+
+def cached_ips(ssm):
+    # -- the IP ranges (and their hash) from the last run, or {} if there are none
+    try:
+        return json.loads(ssm.get_parameter(Name=IP_PARAMETER)['Parameter']['Value'])
+    except ClientError:
+        return {}
+
+def cache_ips(ssm,ip,sha256):
+    ssm.put_parameter(
+        Name=IP_PARAMETER,
+        Value=json.dumps({ 'sha256' : sha256, 'ipv4_cidrs' : ip['ipv4_cidrs'], 'ipv6_cidrs' : ip['ipv6_cidrs'] }),
+        Type='String',
+        Overwrite=True
+    )
+
+def canonical(policy):
+    # -- the policy with its lists sorted, so the order of the IP ranges doesn't matter when comparing
+    if isinstance(policy,dict):
+        return { k : canonical(v) for k,v in policy.items() }
+    if isinstance(policy,list):
+        return sorted((canonical(v) for v in policy),key = json.dumps)
+    return policy
     
-def update_bucket_policy(bucket_name,ip):
-    print(f"Updating bucket policy : {bucket_name}")
+def update_bucket_policy(bucket_name,ip,s3):
+    # -- returns True if the policy had to be updated, False if it was already right
     policy = {
         "Version": "2008-10-17",
         "Id": "PolicyForCloudFlareContent",
@@ -28,41 +81,86 @@ def update_bucket_policy(bucket_name,ip):
                 "Resource": f"arn:aws:s3:::{bucket_name}/*",
                 "Condition": {
                     "IpAddress": {
-                        "aws:SourceIp": 
+                        "aws:SourceIp": collapse_cidrs(
                             ip['ipv4_cidrs'] + 
                             ip['ipv6_cidrs']
+                        )
                     }
                 }
             }
         ]
     }
     
-    boto3.client('s3').put_bucket_policy(Bucket=bucket_name, Policy=json.dumps(policy))
-
-def find_buckets():
-    result = []
-    s3 = boto3.client('s3')
-    for page in s3.list_buckets()['Buckets']:
-        print(page['Name'])
-        tags = {}
-        try:
-            for t in s3.get_bucket_tagging(Bucket=page['Name'])['TagSet']:
-                tags[t['Key']] = t['Value']
-            print(tags)
-        except ClientError:
-            print(" - no tags")
-
-        if tags.get('cloudflare') == 'true':
-            result.append(page['Name'])
-    return result
+    try:
+        current = json.loads(s3.get_bucket_policy(Bucket=bucket_name)['Policy'])
+    except ClientError:
+        current = None
+    if current is not None and canonical(current) == canonical(policy):
+        print(f"Bucket policy is up to date : {bucket_name}")
+        return False
+
+    print(f"Updating bucket policy : {bucket_name}")
+    s3.put_bucket_policy(Bucket=bucket_name, Policy=json.dumps(policy))
+    return True
+
+def bucket_tags(bucket_name,s3):
+    tags = {}
+    try:
+        for t in s3.get_bucket_tagging(Bucket=bucket_name)['TagSet']:
+            tags[t['Key']] = t['Value']
+        print(f"{bucket_name} {tags}")
+    except ClientError:
+        print(f"{bucket_name} - no tags")
+    return tags
+
+def find_buckets(s3,workers = WORKERS):
+    names = [page['Name'] for page in s3.list_buckets()['Buckets']]
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        tags = list(pool.map(lambda name : bucket_tags(name,s3),names))
+    return [name for name,t in zip(names,tags) if t.get('cloudflare') == 'true']
 
 def lambda_handler(event, context):
-    ip = findIps()['result']
-    buckets = find_buckets()
-    for bucket in buckets:
-        update_bucket_policy(bucket,ip)
+    timing = {}
+    start = time.perf_counter()
+    def phase(name):
+        nonlocal start
+        timing[name] = round(time.perf_counter() - start,3)
+        start = time.perf_counter()
+
+    s3 = s3_client()
+    ssm = boto3.client('ssm')
+    cached = cached_ips(ssm)
+    try:
+        ip = findIps()['result']
+    except Exception as e:
+        # -- if Cloudflare can't be reached, the ranges from the last run are still the best we have
+        if not cached:
+            raise
+        print(f"Unable to read the Cloudflare IPs ({e}) - using the ones from the last run")
+        ip = cached
+    sha256 = ip_hash(ip)
+    changed = sha256 != cached.get('sha256')
+    if changed:
+        print(f"The Cloudflare IPs have changed - {sha256}")
+        cache_ips(ssm,ip,sha256)
+    phase('find_ips')
+
+    buckets = find_buckets(s3)
+    phase('find_buckets')
+
+    with ThreadPoolExecutor(max_workers = WORKERS) as pool:
+        updated = list(pool.map(lambda bucket : update_bucket_policy(bucket,ip,s3),buckets))
+    phase('update_policies')
+    print(f"Timing : {timing}")
+    print(f"{updated.count(True)} bucket policies updated, {updated.count(False)} already up to date")
 
     return {
         'statusCode': 200,
-        'body': json.dumps({ 'buckets' : buckets})
+        'body': json.dumps({
+            'buckets' : buckets,
+            'ips_changed' : changed,
+            'updated' : updated.count(True),
+            'skipped' : updated.count(False),
+            'timing' : timing
+        })
     }